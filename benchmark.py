@@ -1,17 +1,284 @@
-#! /usr/bin/env python
-from __future__ import absolute_import
-import scraperwiki
+#!/usr/bin/env python
+# Benchmarks for scraperwiki.sql
+
+'''
+Time the common datastore operations and compare them against a stored
+baseline.
+
+Every benchmark runs against a fresh database in a temporary directory,
+so the scraperwiki.sqlite in the current directory is never touched.
+
+  ./benchmark.py                        run and compare with the baseline
+  ./benchmark.py --save                 run and store the results as the baseline
+  ./benchmark.py save_bulk many_tables  run only the named benchmarks
+
+The exit status is 1 if any benchmark is slower, or uses more memory,
+than the baseline by more than --tolerance. Timings depend on the
+machine, so the baseline isn't kept in the repository: run --save once
+before comparing.
+'''
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
 import os
-from six.moves import range
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
 
-rows = [{'id': i, 'test': i * 2, 's': "abc"} for i in range(1000)]
+import scraperwiki
+from six.moves import range
 
 try:
-    os.remove('scraperwiki.sqlite')
-except OSError:
-    pass
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'benchmark-baseline.json')
+
+BENCHMARKS = []
+
+
+def benchmark(n):
+    '''
+    Register a benchmark. The decorated function does any untimed setup
+    for `n` operations and returns a callable which performs them.
+    '''
+    def register(function):
+        BENCHMARKS.append((function.__name__, n, function))
+        return function
+    return register
+
+
+@benchmark(5000)
+def save_bulk(n):
+    rows = [{'id': i, 'test': i * 2, 's': u"abc"} for i in range(n)]
+    return lambda: scraperwiki.sql.save(['id'], rows)
+
+
+@benchmark(1000)
+def save_per_row(n):
+    rows = [{'id': i, 'test': i * 2, 's': u"abc"} for i in range(n)]
+
+    def run():
+        for row in rows:
+            scraperwiki.sql.save(['id'], row)
+    return run
+
+
+@benchmark(200)
+def save_wide_rows(n):
+    # Every row brings a new column, so every save grows the schema.
+    rows = []
+    for i in range(n):
+        row = {'id': i}
+        row.update((u'column%d' % j, j) for j in range(i + 1))
+        rows.append(row)
+
+    def run():
+        for row in rows:
+            scraperwiki.sql.save(['id'], row)
+    return run
+
+
+@benchmark(50000)
+def select_large(n):
+    rows = [{'id': i, 'test': i * 2, 's': u"xx" * (i % 50)}
+            for i in range(n)]
+    scraperwiki.sql.save(['id'], rows)
+    return lambda: scraperwiki.sql.select('* FROM swdata')
+
+
+@benchmark(50000)
+def export_csv(n):
+    rows = [{'id': i, 'test': i * 2, 's': u"xx" * (i % 50)}
+            for i in range(n)]
+    scraperwiki.sql.save(['id'], rows)
+    path = scraperwiki.sql._State.db_path[len('sqlite:///'):] + '.csv.gz'
+    return lambda: scraperwiki.sql.export('swdata', path, compression='gzip')
+
+
+@benchmark(500)
+def save_get_var(n):
+    def run():
+        for i in range(n):
+            scraperwiki.sql.save_var(u'counter', i)
+            scraperwiki.sql.get_var(u'counter')
+    return run
+
+
+@benchmark(100)
+def many_tables(n):
+    def run():
+        for i in range(n):
+            scraperwiki.sql.save(['id'], {'id': i, 'value': u'v'},
+                                 table_name=u'table%d' % i)
+        scraperwiki.sql.show_tables()
+    return run
+
+
+PRODUCER = """
+import sys
+import scraperwiki
+producer, n = int(sys.argv[1]), int(sys.argv[2])
+for i in range(n):
+    scraperwiki.sql.save(['id'], {'id': producer * n + i, 's': u"abc"})
+"""
+
+
+@benchmark(4000)
+def save_concurrent(n, producers=4):
+    # Several processes saving row by row into one coordinated database.
+    env = dict(os.environ,
+               SCRAPERWIKI_COORDINATED_WRITES='1',
+               SCRAPERWIKI_DATABASE_NAME=scraperwiki.sql._State.db_path,
+               PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+
+    def run():
+        processes = [
+            subprocess.Popen([sys.executable, '-c', PRODUCER,
+                              str(producer), str(n // producers)], env=env)
+            for producer in range(producers)]
+        for process in processes:
+            if process.wait() != 0:
+                raise RuntimeError('producer failed')
+    return run
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return number
+
+
+def fresh_database(path):
+    '''
+    Point scraperwiki.sql at a new, empty database file.
+    '''
+    scraperwiki.sql.commit_transactions()
+    state = scraperwiki.sql._State
+    if state.engine is not None:
+        state.engine.dispose()
+    state.engine = state._connection = state._transaction = None
+    state.metadata = state.table = None
+    state.db_path = 'sqlite:///' + path
+
+
+def peak_memory(run):
+    '''
+    Return the peak memory allocated by run(), in KiB.
+    '''
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1] / 1024.0
+    finally:
+        tracemalloc.stop()
+
+
+def measure(name, n, function, directory, repeat):
+    '''
+    Run one benchmark `repeat` times and return its best throughput
+    together with the peak memory of a separate, traced run.
+    '''
+    best = None
+    for attempt in range(repeat + 1):
+        fresh_database(os.path.join(directory, '%s-%d.sqlite' % (name, attempt)))
+        run = function(n)
+        if attempt == repeat:
+            # Memory tracing slows everything down, so it gets its own run.
+            peak = peak_memory(run)
+            break
+        start = timeit.default_timer()
+        run()
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    fresh_database(os.path.join(directory, 'closed.sqlite'))
+    return {'ops_per_sec': n / best, 'seconds': best, 'peak_kib': peak}
+
+
+def compare(name, result, baseline, tolerance):
+    '''
+    Return a list of descriptions of how `result` regressed from `baseline`.
+    '''
+    problems = []
+    old = baseline.get(name)
+    if old is None:
+        return problems
+    if result['ops_per_sec'] < old['ops_per_sec'] * (1 - tolerance):
+        problems.append('throughput %.0f/s, baseline %.0f/s' %
+                        (result['ops_per_sec'], old['ops_per_sec']))
+    if (result['peak_kib'] is not None and old.get('peak_kib') is not None
+            and result['peak_kib'] > old['peak_kib'] * (1 + tolerance)):
+        problems.append('peak memory %.0f KiB, baseline %.0f KiB' %
+                        (result['peak_kib'], old['peak_kib']))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='baseline file (default: %(default)s)')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--repeat', type=positive_int, default=3,
+                        help='timed runs per benchmark, best is kept')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed fractional regression')
+    args = parser.parse_args(argv)
+
+    known = [name for name, _, _ in BENCHMARKS]
+    for name in args.names:
+        if name not in known:
+            parser.error('unknown benchmark %r, choose from %s' %
+                         (name, ', '.join(known)))
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except IOError:
+        baseline = {}
+        if not args.save:
+            print('No baseline at %s, run with --save to create one' %
+                  args.baseline, file=sys.stderr)
+
+    directory = tempfile.mkdtemp(prefix='scraperwiki-benchmark-')
+    results = {}
+    regressions = 0
+    try:
+        for name, n, function in BENCHMARKS:
+            if args.names and name not in args.names:
+                continue
+            result = measure(name, n, function, directory, args.repeat)
+            results[name] = result
+            peak = result['peak_kib']
+            print('%-16s %10.0f ops/s %9.3f s %12s' % (
+                name, result['ops_per_sec'], result['seconds'],
+                'n/a' if peak is None else '%.0f KiB' % peak))
+            for problem in compare(name, result, baseline, args.tolerance):
+                regressions += 1
+                print('  REGRESSION: %s' % problem)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Saved baseline to %s' % args.baseline)
+        return 0
+
+    return 1 if regressions else 0
 
-scraperwiki.sql.save(['id'], rows)
 
-for i, row in enumerate(rows):
-    scraperwiki.sql.save(['id'], row)
+if __name__ == '__main__':
+    sys.exit(main())
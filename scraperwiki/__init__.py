@@ -7,12 +7,32 @@ https://scraperwiki.com/docs/python/python_help_documentation/
 '''
 from __future__ import absolute_import
 
+import importlib
+import sys
+
 from .utils import scrape, pdftoxml, status, swimport
 from . import utils
-from . import sql
 
-# Compatibility
-sqlite = sql
+if sys.version_info >= (3, 7):
+    # scraperwiki.sql pulls in SQLAlchemy and alembic, which short-lived
+    # scrapers that never touch the datastore shouldn't pay for, so it is
+    # only imported on first use of scraperwiki.sql (or scraperwiki.sqlite).
+    def __getattr__(name):
+        if name in ('sql', 'sqlite'):
+            sql = importlib.import_module('.sql', __name__)
+            # Compatibility
+            globals()['sqlite'] = sql
+            return sql
+        raise AttributeError("module {!r} has no attribute {!r}".format(
+                             __name__, name))
+
+    def __dir__():
+        return sorted(set(globals()) | {'sql', 'sqlite'})
+else:
+    from . import sql
+
+    # Compatibility
+    sqlite = sql
 
 class Error(Exception):
     """All ScraperWiki exceptions are instances of this class
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# _tracehttp.py
+
+'''
+The urllib opener which trace.urlopen() uses to time the phases of HTTP
+requests. It is only imported once something is being traced, as
+http.client and ssl are slow to import.
+'''
+from __future__ import absolute_import
+
+import errno
+import socket
+import sys
+
+import six.moves.http_client
+import six.moves.urllib.request
+
+from .trace import _clock, phase
+
+
+def build_opener():
+    return six.moves.urllib.request.build_opener(
+        _TracedHTTPHandler, _TracedHTTPSHandler)
+
+
+def _connect(connection):
+    """
+    Open the socket for an HTTP connection, resolving its host first so
+    that DNS and connection times are recorded separately, and set it up
+    as http.client's connect() would.
+    """
+    if hasattr(sys, 'audit'):
+        sys.audit('http.client.connect', connection, connection.host,
+                  connection.port)
+    start = _clock()
+    addresses = socket.getaddrinfo(connection.host, connection.port, 0,
+                                   socket.SOCK_STREAM)
+    phase('dns', _clock() - start)
+    start = _clock()
+    error = None
+    for address in addresses:
+        try:
+            sock = socket.create_connection(address[4][:2], connection.timeout,
+                                            connection.source_address)
+            break
+        except socket.error as e:
+            error = e
+    else:
+        raise error
+    phase('connect', _clock() - start)
+    try:
+        # Without this, small requests such as POSTs can stall on Nagle's
+        # algorithm and delayed ACKs.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except socket.error as e:
+        if e.errno != errno.ENOPROTOOPT:
+            raise
+    return sock
+
+
+class _TracedHTTPResponse(six.moves.http_client.HTTPResponse):
+
+    def read(self, amt=None):
+        start = _clock()
+        data = six.moves.http_client.HTTPResponse.read(self, amt)
+        phase('download', _clock() - start, len(data))
+        return data
+
+
+class _TracedConnection(object):
+
+    response_class = _TracedHTTPResponse
+
+    def getresponse(self, *args, **kwargs):
+        start = _clock()
+        response = super(_TracedConnection, self).getresponse(*args, **kwargs)
+        phase('wait', _clock() - start)
+        return response
+
+
+class _TracedHTTPConnection(_TracedConnection,
+                            six.moves.http_client.HTTPConnection):
+
+    def connect(self):
+        if self._tunnel_host:
+            # Through a proxy the phases aren't told apart.
+            return six.moves.http_client.HTTPConnection.connect(self)
+        self.sock = _connect(self)
+
+
+class _TracedHTTPSConnection(_TracedConnection,
+                             six.moves.http_client.HTTPSConnection):
+
+    def connect(self):
+        if self._tunnel_host:
+            return six.moves.http_client.HTTPSConnection.connect(self)
+        sock = _connect(self)
+        start = _clock()
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+        phase('tls', _clock() - start)
+
+
+class _TracedHTTPHandler(six.moves.urllib.request.HTTPHandler):
+
+    def do_open(self, http_class, request, **kwargs):
+        return six.moves.urllib.request.HTTPHandler.do_open(
+            self, _TracedHTTPConnection, request, **kwargs)
+
+
+class _TracedHTTPSHandler(six.moves.urllib.request.HTTPSHandler):
+
+    def do_open(self, http_class, request, **kwargs):
+        return six.moves.urllib.request.HTTPSHandler.do_open(
+            self, _TracedHTTPSConnection, request, **kwargs)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# queue.py
+
+'''
+A persistent work queue, such as a crawl frontier, kept in the datastore
+next to the data it produces.
+
+    from scraperwiki import queue
+
+    def handle(url, html):
+        scraperwiki.sql.save(['url'], dict(url=url, html=html))
+        queue.enqueue(links_in(html))
+
+    queue.enqueue(['http://example.com/'])
+    queue.crawl(handle, workers=8)
+
+Items are claimed in batches with a single UPDATE, so several processes
+can work through one queue without handing out an item twice. A claim
+that isn't completed within its lease, for instance because the process
+crashed, returns to the queue, so a crawl resumes by running it again.
+'''
+from __future__ import absolute_import
+
+import contextlib
+import functools
+import itertools
+import time
+import uuid
+
+from multiprocessing.pool import ThreadPool
+
+import six.moves.urllib.parse
+
+from . import scheduler as _scheduler
+from . import sql
+from . import utils
+
+TABLE_NAME = 'swqueue'
+LEASE_SECONDS = 300
+# Fetches of an item that may fail before fail() gives up on it.
+MAX_ATTEMPTS = 3
+
+PENDING, CLAIMED, DONE, FAILED = 'pending', 'claimed', 'done', 'failed'
+
+
+@contextlib.contextmanager
+def _transaction():
+    """
+    Run queue statements on the datastore connection and commit them.
+    """
+    sql.flush()
+    connection = sql._State.connection()
+    with sql._write_lock():
+        _create_table(connection)
+        yield connection
+    sql._State.new_transaction()
+
+
+def _create_table(connection):
+    connection.execute(u"""
+        CREATE TABLE IF NOT EXISTS {0} (
+            id INTEGER PRIMARY KEY,
+            queue TEXT NOT NULL,
+            item TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            state TEXT NOT NULL DEFAULT '{1}',
+            claim TEXT,
+            claimed_at REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            UNIQUE (queue, item))""".format(TABLE_NAME, PENDING))
+    # Serves claim() in order, without sorting.
+    connection.execute(
+        u'CREATE INDEX IF NOT EXISTS {0}_next '
+        u'ON {0} (queue, state, priority DESC, id)'.format(TABLE_NAME))
+    connection.execute(
+        u'CREATE INDEX IF NOT EXISTS {0}_claim ON {0} (claim)'.format(
+            TABLE_NAME))
+
+
+def enqueue(items, priority=0, queue='default'):
+    """
+    Add items (strings, such as URLs) to the queue. Items already in the
+    queue, in whatever state, are left alone. Higher priority items are
+    claimed first. Returns the number of items added.
+    """
+    if isinstance(items, (type(u''), bytes)):
+        items = [items]
+    rows = [(queue, item, priority) for item in items]
+    if not rows:
+        return 0
+    with _transaction() as connection:
+        result = connection.execute(
+            u'INSERT OR IGNORE INTO {} (queue, item, priority) '
+            u'VALUES (?, ?, ?)'.format(TABLE_NAME), rows)
+        return result.rowcount
+
+
+def claim(n=1, queue='default', lease=LEASE_SECONDS):
+    """
+    Claim up to n pending items, highest priority first, and return them.
+    Claims older than `lease` seconds are returned to the queue first.
+    """
+    return _claim(n, queue, lease)[1]
+
+
+def _claim(n, queue, lease):
+    """
+    Claim items like claim(), returning the claim's token with them.
+    """
+    token = uuid.uuid4().hex
+    now = time.time()
+    with _transaction() as connection:
+        connection.execute(
+            u'UPDATE {} SET state = ?, claim = NULL '
+            u'WHERE queue = ? AND state = ? AND claimed_at < ?'.format(
+                TABLE_NAME), [PENDING, queue, CLAIMED, now - lease])
+        connection.execute(
+            u'UPDATE {0} SET state = ?, claim = ?, claimed_at = ?, '
+            u'attempts = attempts + 1 WHERE id IN ('
+            u'SELECT id FROM {0} WHERE queue = ? AND state = ? '
+            u'ORDER BY priority DESC, id LIMIT ?)'.format(TABLE_NAME),
+            [CLAIMED, token, now, queue, PENDING, n])
+        result = connection.execute(
+            u'SELECT item FROM {} WHERE claim = ? '
+            u'ORDER BY priority DESC, id'.format(TABLE_NAME), [token])
+        return token, [row[0] for row in result.fetchall()]
+
+
+def complete(items, queue='default'):
+    """
+    Mark claimed items as done. Items which are no longer claimed, for
+    instance because their lease expired, are left alone.
+    """
+    _finish(items, queue, DONE, None)
+
+
+def fail(items, queue='default', error=None, retry=True):
+    """
+    Mark claimed items as failed, recording `error`. If `retry` is true
+    they go back to the queue until they have been tried MAX_ATTEMPTS
+    times. Items which are no longer claimed are left alone.
+    """
+    _finish(items, queue, PENDING if retry else FAILED, error)
+
+
+def _finish(items, queue, state, error, token=None):
+    """
+    Move claimed items to `state`. Given the `token` of a claim, only
+    items still held by that claim are moved, so a worker whose lease
+    expired can't finish items another worker has since claimed.
+    """
+    if isinstance(items, (type(u''), bytes)):
+        items = [items]
+    rows = [(state, MAX_ATTEMPTS, state, error, queue, item, CLAIMED, token)
+            for item in items]
+    if not rows:
+        return
+    with _transaction() as connection:
+        # Items to be retried fail for good once out of attempts.
+        connection.execute(
+            u"UPDATE {} SET state = CASE WHEN ? = '{}' AND attempts >= ? "
+            u"THEN '{}' ELSE ? END, claim = NULL, error = ? "
+            u"WHERE queue = ? AND item = ? AND state = ? "
+            u"AND claim = coalesce(?, claim)".format(
+                TABLE_NAME, PENDING, FAILED), rows)
+
+
+def counts(queue='default'):
+    """
+    Return the number of items in each state.
+    """
+    with _transaction() as connection:
+        result = connection.execute(
+            u'SELECT state, count(*) FROM {} WHERE queue = ? '
+            u'GROUP BY state'.format(TABLE_NAME), [queue])
+        found = dict(result.fetchall())
+    return dict((state, found.get(state, 0))
+                for state in (PENDING, CLAIMED, DONE, FAILED))
+
+
+def _interleave(items):
+    """
+    Reorder URLs so that consecutive ones are for different hosts, which
+    keeps workers from queueing up behind one host's limits.
+    """
+    hosts = {}
+    for item in items:
+        host = six.moves.urllib.parse.urlsplit(item).netloc
+        hosts.setdefault(host, []).append(item)
+    rounds = six.moves.zip_longest(*hosts.values())
+    return [item for item in itertools.chain.from_iterable(rounds)
+            if item is not None]
+
+
+def crawl(handle, queue='default', workers=4, batch=None,
+          lease=LEASE_SECONDS, fetch=None, scheduler=None):
+    """
+    Work through the queue until it is empty: claim a batch of items,
+    fetch them with `workers` threads using `fetch` (scraperwiki.scrape
+    with `scheduler`, or a new Scheduler, by default), and call
+    handle(item, content) for each in this thread, where it may save
+    data and enqueue more items. Items whose fetch raises are failed and
+    retried later; an exception from `handle` stops the crawl, and its
+    unfinished items are retried once their lease expires.
+    """
+    if fetch is None:
+        fetch = functools.partial(
+            utils.scrape, scheduler=scheduler or _scheduler.Scheduler())
+    batch = batch or workers * 4
+
+    def fetch_one(item):
+        try:
+            return item, fetch(item), None
+        except Exception as e:
+            return item, None, e
+
+    pool = ThreadPool(workers)
+    try:
+        while True:
+            token, items = _claim(batch, queue, lease)
+            if not items:
+                break
+            done = []
+            for item, content, error in pool.imap_unordered(
+                    fetch_one, _interleave(items)):
+                if error is not None:
+                    _finish([item], queue, PENDING, repr(error), token)
+                    continue
+                handle(item, content)
+                done.append(item)
+            _finish(done, queue, DONE, None, token)
+    finally:
+        pool.close()
+        pool.join()
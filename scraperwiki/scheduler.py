@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# scheduler.py
+
+'''
+Politeness and throughput control for scraperwiki.scrape.
+
+A Scheduler keeps, for every host, a token bucket which limits the rate
+of requests and a concurrency limit which adapts to how the host copes:
+it starts at one request at a time and grows while response times stay
+close to the fastest seen, shrinks gently when they rise, and halves on
+errors. A 429 or 503 response stops all requests to its host for the
+time given by Retry-After (or an exponential backoff) before the request
+is retried. Hosts are limited independently, so a crawl spread over many
+hosts runs as fast as each of them allows.
+
+    from scraperwiki.scheduler import Scheduler
+    scheduler = Scheduler(rate=2)
+    scraperwiki.scrape(url, scheduler=scheduler)
+
+Setting SCRAPERWIKI_RATE_LIMIT makes every scrape() use a shared
+scheduler limited to that many requests a second per host.
+'''
+from __future__ import absolute_import
+
+import contextlib
+import email.utils
+import os
+import threading
+import time
+
+import six.moves.urllib.error
+import six.moves.urllib.parse
+import six.moves.urllib.request
+
+# Requests a second, and the most requests at once, allowed to each host.
+RATE_LIMIT = float(os.environ.get("SCRAPERWIKI_RATE_LIMIT", 0)) or None
+MAX_CONCURRENCY = int(os.environ.get("SCRAPERWIKI_MAX_CONCURRENCY", 8))
+# Concurrency only grows while response times are within this factor of
+# the fastest response from the host, plus some slack for jitter.
+LATENCY_TOLERANCE = 2.0
+LATENCY_SLACK = 0.05
+RETRIES = 3
+# Status codes which mean the host wants us to slow down.
+THROTTLED = (429, 503)
+
+_clock = getattr(time, 'monotonic', time.time)
+_default = None
+_default_lock = threading.Lock()
+
+
+class TokenBucket(object):
+
+    """
+    Allow `rate` events a second on average, and up to `burst` at once.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = _clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available. Returns the number
+        of seconds slept.
+        """
+        with self.lock:
+            now = _clock()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Going into debt reserves the next token for this caller.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class _Host(object):
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.limit = 1.0
+        self.active = 0
+        self.fastest = None
+        self.blocked_until = 0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+
+
+class Scheduler(object):
+
+    """
+    Schedule requests so that no host gets more than `rate` requests a
+    second (unlimited if None) or more than `max_concurrency` at once.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, burst=1,
+                 max_concurrency=MAX_CONCURRENCY, retries=RETRIES):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self._hosts = {}
+        self._condition = threading.Condition()
+
+    def _host(self, url):
+        host = six.moves.urllib.parse.urlsplit(url).netloc.lower()
+        with self._condition:
+            if host not in self._hosts:
+                self._hosts[host] = _Host(self.rate, self.burst)
+            return self._hosts[host]
+
+    @contextlib.contextmanager
+    def slot(self, url):
+        """
+        Wait until a request to the host of `url` is allowed, and hold one
+        of its concurrency slots until the block ends. The block should
+        call report() with the outcome.
+        """
+        host = self._host(url)
+        with self._condition:
+            while True:
+                wait = host.blocked_until - _clock()
+                if wait <= 0 and host.active < int(host.limit):
+                    break
+                self._condition.wait(wait if wait > 0 else None)
+            host.active += 1
+            host.requests += 1
+        try:
+            if host.bucket is not None:
+                host.bucket.acquire()
+            yield host
+        finally:
+            with self._condition:
+                host.active -= 1
+                self._condition.notify_all()
+
+    def report(self, host, latency=None, error=False, retry_after=None):
+        """
+        Adjust the concurrency limit of `host` after a request which took
+        `latency` seconds, failed, or was throttled for `retry_after`
+        seconds.
+        """
+        with self._condition:
+            if retry_after is not None:
+                host.throttled += 1
+                host.blocked_until = max(host.blocked_until,
+                                         _clock() + retry_after)
+                host.limit = max(1.0, host.limit / 2)
+            elif error:
+                host.errors += 1
+                host.limit = max(1.0, host.limit / 2)
+            elif latency is not None:
+                if host.fastest is None or latency < host.fastest:
+                    host.fastest = latency
+                ceiling = host.fastest * LATENCY_TOLERANCE + LATENCY_SLACK
+                if latency <= ceiling:
+                    # Roughly one more slot for each full round of requests.
+                    host.limit = min(self.max_concurrency,
+                                     host.limit + 1.0 / host.limit)
+                else:
+                    host.limit = max(1.0, host.limit * 0.9)
+            self._condition.notify_all()
+
+    def fetch(self, request, urlopen=None):
+        """
+        Open a urllib Request with `urlopen` (urllib's by default) when the
+        scheduler allows, retrying when the host asks us to slow down, and
+        return the response body.
+        """
+        urlopen = urlopen or six.moves.urllib.request.urlopen
+        for attempt in range(self.retries + 1):
+            with self.slot(request.get_full_url()) as host:
+                start = _clock()
+                try:
+                    f = urlopen(request)
+                except six.moves.urllib.error.HTTPError as e:
+                    if e.code not in THROTTLED or attempt == self.retries:
+                        self.report(host, error=True)
+                        raise
+                    self.report(host, retry_after=_retry_after(
+                        e.info().get('Retry-After'), attempt))
+                    e.close()
+                    continue
+                except Exception:
+                    self.report(host, error=True)
+                    raise
+                latency = _clock() - start
+                try:
+                    text = f.read()
+                finally:
+                    f.close()
+                self.report(host, latency=latency)
+                return text
+
+    def stats(self):
+        """
+        Return a dict of counters and the current limit for each host.
+        """
+        with self._condition:
+            return dict((name, dict(concurrency=int(host.limit),
+                                    requests=host.requests,
+                                    errors=host.errors,
+                                    throttled=host.throttled))
+                        for name, host in self._hosts.items())
+
+
+def _retry_after(value, attempt):
+    """
+    Return the seconds to wait given a Retry-After header, which is either
+    a number of seconds or an HTTP date, falling back to an exponential
+    backoff.
+    """
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            parsed = email.utils.parsedate_tz(value)
+            if parsed is not None:
+                return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+    return 2.0 ** attempt
+
+
+def default():
+    """
+    Return the scheduler shared by scrape() calls when
+    SCRAPERWIKI_RATE_LIMIT is set.
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Scheduler()
+        return _default
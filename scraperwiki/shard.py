@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# shard.py
+
+'''
+Save rows to tables split across several SQLite files.
+
+Each row is routed to one of SCRAPERWIKI_DATABASE_SHARDS files, either by
+a hash of its unique keys or by a hash of a partition column. Rows with
+the same unique keys always land in the same shard, so INSERT OR REPLACE
+behaves as it does for scraperwiki.sql.save. Each shard is locked
+independently, so several processes can write at once as long as they
+mostly write to different shards, for instance by partitioning on a
+column that differs between them.
+
+    from scraperwiki import shard
+    shard.save(['id'], rows, partition='source')
+    shard.select('* FROM swdata WHERE price > ?', [10])
+
+select() attaches every shard to one connection and queries a temporary
+view which is the UNION ALL of a table's shards, so WHERE, ORDER BY and
+aggregates work across all of them. SQLite can attach only so many files
+at once (MAX_ATTACHED unless the limit can be raised); with more shards
+than that, they are attached a batch at a time and their tables copied
+into temporary tables, which are queried instead.
+'''
+from __future__ import absolute_import
+try:
+    from collections.abc import Iterable, Mapping
+except ImportError:
+    from collections import Iterable, Mapping
+
+import atexit
+import itertools
+import os
+import re
+import sqlite3
+import time
+import zlib
+
+import sqlalchemy.dialects.sqlite
+import sqlalchemy.engine.url
+
+from . import sql
+
+DATABASE_SHARDS = int(os.environ.get("SCRAPERWIKI_DATABASE_SHARDS", 4))
+# Files SQLite can attach to one connection unless it is built with, and
+# Python can set, a higher limit.
+MAX_ATTACHED = 10
+unicode = type(u'')
+
+_dialect = sqlalchemy.dialects.sqlite.dialect(
+    json_serializer=sql._json_dumps)
+# Bind processors for each Python type, see _bind().
+_processors = {}
+
+
+def _default_path():
+    database = sqlalchemy.engine.url.make_url(sql.DATABASE_NAME).database
+    root, extension = os.path.splitext(database or 'scraperwiki.sqlite')
+    return root + '-{}' + extension
+
+
+class _State(object):
+
+    """
+    This class maintains the connections to the shards. It does not form
+    part of the public interface.
+    """
+    shards = DATABASE_SHARDS
+    # Formatted with the shard number to give the path of each shard.
+    path = _default_path()
+    _connections = None
+    # Columns of each table in each shard, keyed by (shard, table name).
+    columns = {}
+    last_commit = None
+    round_robin = None
+
+    @classmethod
+    def connection(cls, shard):
+        if cls._connections is None:
+            cls._connections = [
+                sqlite3.connect(cls.path.format(number),
+                                timeout=sql.DATABASE_TIMEOUT)
+                for number in range(cls.shards)]
+            cls.last_commit = time.time()
+            cls.round_robin = itertools.cycle(range(cls.shards))
+        return cls._connections[shard]
+
+    @classmethod
+    def commit(cls):
+        cls.last_commit = time.time()
+        for connection in cls._connections or []:
+            connection.commit()
+
+    @classmethod
+    def check_last_committed(cls):
+        if time.time() - cls.last_commit > sql.SECONDS_BETWEEN_COMMIT:
+            cls.commit()
+
+    @classmethod
+    def close(cls):
+        cls.commit()
+        for connection in cls._connections or []:
+            connection.close()
+        cls._connections = None
+        cls.columns = {}
+
+
+def configure(shards, path=None):
+    """
+    Use `shards` shard files from now on. `path` is formatted with the
+    shard number to give the file name of each shard; by default it is
+    derived from SCRAPERWIKI_DATABASE_NAME. Changing the number of shards
+    of an existing datastore does not move rows already saved.
+    """
+    _State.close()
+    _State.shards = shards
+    _State.path = _default_path() if path is None else path
+
+
+@atexit.register
+def commit_transactions():
+    """
+    Ensure any outstanding transactions are committed on exit
+    """
+    if _State is not None:
+        _State.commit()
+
+
+def _quote(name):
+    return _dialect.identifier_preparer.quote_identifier(name)
+
+
+def shard_for(row, unique_keys, partition=None):
+    """
+    Return the number of the shard that `row` belongs in.
+    """
+    keys = [partition] if partition is not None else unique_keys
+    if not keys:
+        _State.connection(0)
+        return next(_State.round_robin)
+    key = u'\x1f'.join(unicode(row[k]) for k in keys).encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % _State.shards
+
+
+def save(unique_keys, data, table_name='swdata', partition=None):
+    """
+    Save the given data to the table specified by `table_name`, like
+    scraperwiki.sql.save, routing each row to a shard by a hash of its
+    unique keys or of the `partition` column. Rows without either are
+    spread over the shards in turn.
+    """
+    if isinstance(data, Mapping):
+        data = [data]
+    elif not isinstance(data, Iterable):
+        raise TypeError("Data must be a single mapping or an iterable "
+                        "of mappings")
+
+    for row in data:
+        if not isinstance(row, Mapping):
+            raise TypeError("Elements of data must be mappings, got {}".format(
+                            type(row)))
+        shard = shard_for(row, unique_keys, partition)
+        connection = _State.connection(shard)
+        _fit_row(shard, table_name, row, unique_keys)
+
+        columns = list(row.keys())
+        values = [_bind(value) for value in row.values()]
+        connection.execute(u'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+            _quote(table_name),
+            u', '.join(_quote(column) for column in columns),
+            u', '.join([u'?'] * len(columns))), values)
+    _State.check_last_committed()
+
+
+def _bind(value):
+    """
+    Convert a value for storage the way scraperwiki.sql.save would.
+    """
+    try:
+        process = _processors[type(value)]
+    except KeyError:
+        column_type = sql.get_column_type(value)()
+        process = column_type.dialect_impl(_dialect).bind_processor(_dialect)
+        _processors[type(value)] = process
+    return value if process is None else process(value)
+
+
+def _fit_row(shard, table_name, row, unique_keys):
+    """
+    Create the table in the shard, or add any columns it lacks, so that
+    `row` fits in it.
+    """
+    connection = _State.connection(shard)
+    columns = _State.columns.get((shard, table_name))
+    if columns is None:
+        columns = _table_columns(connection, table_name)
+        _State.columns[(shard, table_name)] = columns
+
+    def definition(name, value):
+        return u'{} {}'.format(
+            _quote(name), sql.get_column_type(value)().compile(dialect=_dialect))
+
+    if not columns:
+        connection.execute(u'CREATE TABLE IF NOT EXISTS {} ({})'.format(
+            _quote(table_name),
+            u', '.join(definition(name, value) for name, value in row.items())))
+        if unique_keys:
+            index_name = re.sub(r'[^a-zA-Z0-9]', '', table_name) + '_'
+            index_name += '_'.join(re.sub(r'[^a-zA-Z0-9]', '', x)
+                                   for x in unique_keys) + '_unique'
+            connection.execute(
+                u'CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                    _quote(index_name), _quote(table_name),
+                    u', '.join(_quote(key) for key in unique_keys)))
+        # Another process may have created the table first.
+        columns.extend(_table_columns(connection, table_name))
+
+    for name, value in row.items():
+        if name in columns:
+            continue
+        try:
+            connection.execute(u'ALTER TABLE {} ADD COLUMN {}'.format(
+                _quote(table_name), definition(name, value)))
+        except sqlite3.OperationalError as e:
+            # Another process may have added the column first.
+            if 'duplicate column' not in str(e):
+                raise
+        columns.append(name)
+
+
+def _table_columns(connection, table_name, schema='main'):
+    return [name for name, _ in _table_info(connection, table_name, schema)]
+
+
+def _table_info(connection, table_name, schema='main'):
+    """
+    Return the name and declared type of each column of a table.
+    """
+    cursor = connection.execute(
+        u'PRAGMA {}.table_info({})'.format(schema, _quote(table_name)))
+    return [(column[1], column[2]) for column in cursor.fetchall()]
+
+
+def _rows(cursor, decoders):
+    keys = [column[0] for column in cursor.description or []]
+    if not any(decoders):
+        return [dict(zip(keys, row)) for row in cursor.fetchall()]
+    return [dict(zip(keys, sql._decode_row(row, decoders)))
+            for row in cursor.fetchall()]
+
+
+def select(query, data=None):
+    """
+    Perform a sql select statement with the given query (without 'select')
+    across all shards and return any results as a list of dicts.
+    """
+    if data is None:
+        data = []
+    _State.connection(0)
+    _State.commit()
+
+    connection = sqlite3.connect(':memory:')
+    try:
+        if _State.shards <= _attach_limit(connection):
+            for shard in range(_State.shards):
+                _attach(connection, shard)
+            _create_views(connection)
+        else:
+            _copy_shards(connection)
+        # JSON and compressed columns are decoded as sql.select() does.
+        decoders = [sql._decoder(declared_type) for declared_type in
+                    sql._declared_types(connection, 'select ' + query)]
+        return _rows(connection.execute('select ' + query, data), decoders)
+    finally:
+        connection.close()
+
+
+def _attach_limit(connection):
+    """
+    Raise the number of databases `connection` may attach to the number
+    of shards, as far as SQLite allows, and return the limit.
+    """
+    if not hasattr(connection, 'setlimit'):
+        return MAX_ATTACHED
+    connection.setlimit(sqlite3.SQLITE_LIMIT_ATTACHED, _State.shards)
+    return connection.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+
+
+def _attach(connection, shard):
+    connection.execute('ATTACH DATABASE ? AS shard{}'.format(shard),
+                       [_State.path.format(shard)])
+
+
+def _shard_tables(connection, shard):
+    """
+    Return (name, columns) for each table in an attached shard, where
+    columns is a list of (name, declared type).
+    """
+    schema = 'shard{}'.format(shard)
+    cursor = connection.execute(
+        "SELECT name FROM {}.sqlite_master WHERE type='table'".format(schema))
+    return [(name, _table_info(connection, name, schema))
+            for (name,) in cursor.fetchall()]
+
+
+def _batches(connection):
+    """
+    Attach the shards a batch at a time, detaching each batch after the
+    caller has used it, and yield the shard numbers of each batch.
+    """
+    limit = _attach_limit(connection)
+    for start in range(0, _State.shards, limit):
+        batch = range(start, min(start + limit, _State.shards))
+        for shard in batch:
+            _attach(connection, shard)
+        try:
+            yield batch
+        finally:
+            # A shard can't be detached inside the copy's transaction.
+            connection.commit()
+            for shard in batch:
+                connection.execute('DETACH DATABASE shard{}'.format(shard))
+
+
+def _copy_shards(connection):
+    """
+    Copy every table of every shard into a temporary table holding the
+    union of its columns, for when there are too many shards to attach
+    at once.
+    """
+    tables = {}
+    for batch in _batches(connection):
+        for shard in batch:
+            for name, source_columns in _shard_tables(connection, shard):
+                columns = tables.setdefault(name, [])
+                names = [c for c, _ in columns]
+                columns.extend(c for c in source_columns if c[0] not in names)
+
+    for name, columns in tables.items():
+        connection.execute(u'CREATE TEMP TABLE {} ({})'.format(
+            _quote(name), u', '.join(u'{} {}'.format(_quote(c), declared_type)
+                                     for c, declared_type in columns)))
+    for batch in _batches(connection):
+        for shard in batch:
+            for name, source_columns in _shard_tables(connection, shard):
+                connection.execute(
+                    u'INSERT INTO temp.{0} ({1}) SELECT {1} FROM shard{2}.{0}'
+                    .format(_quote(name),
+                            u', '.join(_quote(c) for c, _ in source_columns),
+                            shard))
+
+
+def _create_views(connection):
+    """
+    Create a temporary view for every table in the attached shards, which
+    selects the union of its columns from all shards.
+    """
+    tables = {}
+    for shard in range(_State.shards):
+        for name, columns in _shard_tables(connection, shard):
+            tables.setdefault(name, []).append(
+                ('shard{}'.format(shard), [c for c, _ in columns]))
+
+    for name, sources in tables.items():
+        columns = []
+        for _, source_columns in sources:
+            columns.extend(c for c in source_columns if c not in columns)
+        selects = []
+        for schema, source_columns in sources:
+            selects.append(u'SELECT {} FROM {}.{}'.format(
+                u', '.join(_quote(c) if c in source_columns
+                           else u'NULL AS ' + _quote(c) for c in columns),
+                schema, _quote(name)))
+        connection.execute(u'CREATE TEMP VIEW {} AS {}'.format(
+            _quote(name), u' UNION ALL '.join(selects)))
+
+
+def commit():
+    """
+    Commit outstanding rows in all shards.
+    """
+    _State.commit()
@@ -1,21 +1,80 @@
 from __future__ import absolute_import, print_function
-from collections import Iterable, Mapping, OrderedDict
+try:
+    from collections.abc import Iterable, Mapping
+except ImportError:
+    from collections import Iterable, Mapping
 
 import atexit
+import base64
+import bz2
+import contextlib
+import csv
 import datetime
+import gzip
+import io
+import json
 import time
 import os
 import re
+import sqlite3
+import uuid
 import warnings
+import zlib
 
-import alembic.ddl
 import sqlalchemy
+import sqlalchemy.dialects.sqlite
 import six
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 DATABASE_NAME = os.environ.get("SCRAPERWIKI_DATABASE_NAME",
                                "sqlite:///scraperwiki.sqlite")
 
 DATABASE_TIMEOUT = float(os.environ.get("SCRAPERWIKI_DATABASE_TIMEOUT", 300))
+# "sqlite3" writes rows through the stdlib sqlite3 driver directly when the
+# database is SQLite; "sqlalchemy" compiles every insert with SQLAlchemy.
+DATABASE_BACKEND = os.environ.get("SCRAPERWIKI_DATABASE_BACKEND", "sqlite3")
+# When set, save() buffers rows and writes them in batches of at most
+# WRITE_BATCH_SIZE rows while holding a lock file, so that several processes
+# writing to one SQLite file take turns rather than busy-waiting.
+COORDINATED_WRITES = bool(os.environ.get("SCRAPERWIKI_COORDINATED_WRITES"))
+if COORDINATED_WRITES and fcntl is None:
+    raise ImportError("SCRAPERWIKI_COORDINATED_WRITES needs fcntl.flock, "
+                      "which this platform lacks")
+WRITE_BATCH_SIZE = int(os.environ.get("SCRAPERWIKI_WRITE_BATCH_SIZE", 1000))
+# When set, tables created by save() record which rows change, for
+# changes_since(); see track_changes().
+TRACK_CHANGES = bool(os.environ.get("SCRAPERWIKI_TRACK_CHANGES"))
+# "log" records the indexes that would avoid the full table scans made by
+# select() and execute(), see index_suggestions(); "create" also creates them.
+INDEX_ADVISOR = os.environ.get("SCRAPERWIKI_INDEX_ADVISOR", "")
+# auto_vacuum mode given to new SQLite databases. "incremental" lets
+# maintain() hand free pages back to the filesystem a few at a time.
+AUTO_VACUUM = os.environ.get("SCRAPERWIKI_AUTO_VACUUM", "incremental")
+# Seconds between the maintain() runs made after a commit, each of which
+# stops starting new work after MAINTENANCE_BUDGET seconds. 0 disables them.
+MAINTENANCE_INTERVAL = float(os.environ.get(
+    "SCRAPERWIKI_MAINTENANCE_INTERVAL", 0))
+MAINTENANCE_BUDGET = float(os.environ.get("SCRAPERWIKI_MAINTENANCE_BUDGET",
+                                          0.05))
+# maintain() checkpoints the write-ahead log once it is this large.
+WAL_CHECKPOINT_BYTES = 16 * 1024 * 1024
+VACUUM_STEP_PAGES = 256
+# Codec for CompressedBlob and CompressedText values: "zstd" when the
+# zstandard package is installed, otherwise "zlib". Values shorter than
+# COMPRESSION_THRESHOLD bytes are stored uncompressed.
+COMPRESSION = os.environ.get("SCRAPERWIKI_COMPRESSION",
+                             "zstd" if zstandard is not None else "zlib")
+COMPRESSION_THRESHOLD = int(os.environ.get(
+    "SCRAPERWIKI_COMPRESSION_THRESHOLD", 1024))
 SECONDS_BETWEEN_COMMIT = 2
 unicode = type(u'')
 
@@ -27,6 +86,122 @@ class Blob(bytes):
     """
     Represents a blob as a string.
     """
+
+
+class JSON(sqlalchemy.types.JSON):
+
+    """
+    Stores dicts and lists as JSON text, in a column declared JSON. None
+    is stored as NULL rather than as JSON null.
+    """
+
+    def __init__(self, none_as_null=True):
+        super(JSON, self).__init__(none_as_null=none_as_null)
+
+
+def _json_dumps(value):
+    # Unescaped, as SQLite's JSON paths don't match escaped keys.
+    return json.dumps(value, ensure_ascii=False)
+
+
+class CompressedBlob(bytes):
+
+    """
+    Represents a blob to be stored compressed, in a column declared ZBLOB.
+    """
+
+
+class CompressedText(six.text_type):
+
+    """
+    Represents text to be stored compressed, in a column declared ZTEXT.
+    """
+
+
+# Compressed values start with _COMPRESSED_MAGIC and a byte naming the
+# codec. Values stored as they are only get the header if they would
+# otherwise be mistaken for compressed ones.
+_COMPRESSED_MAGIC = b'\x00swz'
+_STORED, _ZLIB, _ZSTD = b'-', b'z', b's'
+
+
+def _compress(data):
+    """
+    Compress bytes with COMPRESSION, unless they are shorter than
+    COMPRESSION_THRESHOLD or don't get any smaller.
+    """
+    if len(data) >= COMPRESSION_THRESHOLD:
+        if COMPRESSION == 'zstd' and zstandard is not None:
+            codec = _ZSTD
+            compressed = zstandard.ZstdCompressor().compress(data)
+        else:
+            codec = _ZLIB
+            compressed = zlib.compress(data)
+        if len(compressed) + len(_COMPRESSED_MAGIC) + 1 < len(data):
+            return _COMPRESSED_MAGIC + codec + compressed
+    if data.startswith(_COMPRESSED_MAGIC):
+        return _COMPRESSED_MAGIC + _STORED + data
+    return data
+
+
+def _decompress(data):
+    data = bytes(data)
+    if not data.startswith(_COMPRESSED_MAGIC):
+        return data
+    codec = data[len(_COMPRESSED_MAGIC):len(_COMPRESSED_MAGIC) + 1]
+    payload = data[len(_COMPRESSED_MAGIC) + 1:]
+    if codec == _ZLIB:
+        return zlib.decompress(payload)
+    if codec == _ZSTD:
+        if zstandard is None:
+            raise ImportError("Reading zstd compressed values needs the "
+                              "zstandard package")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return payload
+
+
+class ZBLOB(sqlalchemy.types.UserDefinedType):
+
+    """
+    A column of bytes compressed by _compress().
+    """
+    text = False
+
+    def get_col_spec(self, **kwargs):
+        return self.__class__.__name__
+
+    def bind_processor(self, dialect):
+        def process(value):
+            if value is None:
+                return None
+            if isinstance(value, six.text_type):
+                value = value.encode('utf-8')
+            return sqlite3.Binary(_compress(bytes(value)))
+        return process
+
+    def result_processor(self, dialect, coltype):
+        return self.decode
+
+    def decode(self, value):
+        if value is None or isinstance(value, six.text_type):
+            return value
+        value = _decompress(value)
+        return value.decode('utf-8') if self.text else value
+
+
+class ZTEXT(ZBLOB):
+
+    """
+    A column of text compressed, as UTF-8, by _compress().
+    """
+    text = True
+
+
+# Let reflection recognise the declared types of compressed columns.
+sqlalchemy.dialects.sqlite.base.ischema_names.setdefault('ZBLOB', ZBLOB)
+sqlalchemy.dialects.sqlite.base.ischema_names.setdefault('ZTEXT', ZTEXT)
+
+
 PYTHON_SQLITE_TYPE_MAP = {
     six.text_type: sqlalchemy.types.Text,
     str: sqlalchemy.types.Text,
@@ -38,6 +213,12 @@ PYTHON_SQLITE_TYPE_MAP = {
     datetime.datetime: sqlalchemy.types.DateTime,
 
     Blob: sqlalchemy.types.LargeBinary,
+
+    dict: JSON,
+    list: JSON,
+
+    CompressedBlob: ZBLOB,
+    CompressedText: ZTEXT,
 }
 
 if bytes is not str:
@@ -67,16 +248,42 @@ class _State(object):
     # accidental uses of it.
     # table_pending = None
     vars_table_name = 'swvariables'
+    changes_table_name = 'swchanges'
+    track_changes = TRACK_CHANGES
+    index_advisor = INDEX_ADVISOR
+    # How often each index would have been used, keyed by
+    # (table name, column names).
+    index_suggestions = {}
     last_commit = None
     echo = False
+    backend = DATABASE_BACKEND
+    coordinated = COORDINATED_WRITES
+    # Rows waiting to be written in coordinated mode, as a list of
+    # (table_name, unique_keys, rows).
+    pending = []
+    pending_rows = 0
+    last_flush = 0
+    flushing = False
+    maintenance_interval = MAINTENANCE_INTERVAL
+    last_maintenance = 0
+    # Tables with columns which select() decodes, and the views, which may
+    # select from them.
+    decoded_tables = set()
+    view_names = None
+    # Declared types of the result columns of each query passed to
+    # select(), as of schema_version.
+    result_types = {}
+    schema_version = None
 
     @classmethod
     def connection(cls):
         if cls._connection is None:
             create = sqlalchemy.create_engine
             cls.engine = create(cls.db_path, echo=cls.echo,
-                                connect_args={'timeout': DATABASE_TIMEOUT})
+                                connect_args={'timeout': DATABASE_TIMEOUT},
+                                json_serializer=_json_dumps)
             cls._connection = cls.engine.connect()
+            cls.set_auto_vacuum()
             cls.new_transaction()
         if cls.table is None:
             cls.reflect_metadata()
@@ -91,19 +298,97 @@ class _State(object):
         cls.last_commit = time.time()
         if cls._transaction is not None:
             cls._transaction.commit()
+            cls._transaction = None
+            if (cls.maintenance_interval and cls.last_commit -
+                    cls.last_maintenance > cls.maintenance_interval):
+                _maintain(MAINTENANCE_BUDGET, wait=False)
         cls._transaction = cls._connection.begin()
 
     @classmethod
-    def reflect_metadata(cls):
+    def set_auto_vacuum(cls):
+        """
+        Set the auto_vacuum mode of a new SQLite database, which can only
+        be done before its first table is created.
+        """
+        if cls.engine.dialect.name != 'sqlite':
+            return
+        cursor = cls._connection.connection.cursor()
+        (pages,), = cursor.execute('PRAGMA page_count').fetchall()
+        if pages == 0:
+            cursor.execute('PRAGMA auto_vacuum = {}'.format(
+                re.sub(r'[^a-zA-Z0-9]', '', AUTO_VACUUM)))
+
+    @classmethod
+    def reflect_metadata(cls, **kwargs):
         if cls.metadata is None:
             cls.metadata = sqlalchemy.MetaData(bind=cls.engine)
-        cls.metadata.reflect()
+        cls.metadata.reflect(**kwargs)
+        cls.decoded_tables = set()
+        for table in cls.metadata.tables.values():
+            for column in table.columns:
+                # Reflected JSON columns would store None as JSON null.
+                if isinstance(column.type, sqlalchemy.types.JSON):
+                    column.type.none_as_null = True
+                if _declared_type(column):
+                    cls.decoded_tables.add(table.name)
+        if cls.engine.dialect.name == 'sqlite':
+            (version,), = cls._connection.connection.cursor().execute(
+                'PRAGMA schema_version').fetchall()
+            if version != cls.schema_version:
+                cls.schema_version = version
+                cls.result_types = {}
+                cls.view_names = None
+
+    @classmethod
+    def use_sqlite3(cls):
+        """
+        Whether rows and columns should be written with the stdlib sqlite3
+        driver rather than through SQLAlchemy.
+        """
+        return (cls.backend == 'sqlite3' and
+                cls.engine.dialect.name == 'sqlite')
 
     @classmethod
     def check_last_committed(cls):
         if time.time() - cls.last_commit > SECONDS_BETWEEN_COMMIT:
             cls.new_transaction()
 
+    @classmethod
+    def lock_path(cls):
+        """
+        The lock file taken by coordinated writers, or None for databases
+        that aren't files.
+        """
+        database = cls.engine.url.database
+        if (cls.engine.dialect.name != 'sqlite' or
+                database in (None, '', ':memory:')):
+            return None
+        return database + '-lock'
+
+
+@contextlib.contextmanager
+def _write_lock():
+    """
+    In coordinated mode, hold the write lock shared with other processes
+    and commit before releasing it. Otherwise do nothing.
+    """
+    _State.connection()
+    path = _State.lock_path() if _State.coordinated else None
+    if path is None:
+        yield
+        return
+    if fcntl is None:
+        raise RuntimeError("Coordinated writes need fcntl.flock, which this "
+                           "platform lacks")
+
+    with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+            _State.new_transaction()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
 
 class Transaction(object):
 
@@ -113,10 +398,12 @@ class Transaction(object):
     """
 
     def __enter__(self):
+        flush()
         _State.connection()
         _State.new_transaction()
 
     def __exit__(self, *args):
+        flush()
         _State._transaction.commit()
         _State._transaction = None
 
@@ -126,11 +413,101 @@ def commit_transactions():
     """
     Ensure any outstanding transactions are committed on exit
     """
+    if _State is not None and _State.pending:
+        flush()
     if _State is not None and _State._transaction is not None:
         _State._transaction.commit()
         _State._transaction = None
 
 
+def maintain(budget=None):
+    """
+    Tidy the database: refresh the query planner's statistics, return
+    free pages to the filesystem (if auto_vacuum is incremental) and
+    checkpoint the write-ahead log once it exceeds WAL_CHECKPOINT_BYTES.
+    No new step is started once `budget` seconds have passed; None means
+    no limit. Returns a dict describing what was done.
+
+    This also runs automatically after commits every
+    SCRAPERWIKI_MAINTENANCE_INTERVAL seconds, if that is set.
+    """
+    flush()
+    _State.connection()
+    _State._transaction.commit()
+    _State._transaction = None
+    try:
+        return _maintain(budget)
+    finally:
+        _State.new_transaction()
+
+
+def _maintain(budget, wait=True):
+    """
+    Do the work of maintain(), between transactions. Unless `wait` is
+    true, steps which find the database locked by another writer are
+    skipped rather than waited for.
+    """
+    _State.last_maintenance = start = time.time()
+    report = {'analyzed': False, 'freed_pages': 0, 'checkpointed': False}
+    if _State.engine.dialect.name != 'sqlite':
+        return report
+
+    def time_left():
+        return budget is None or time.time() - start < budget
+
+    cursor = _State._connection.connection.cursor()
+    if not wait:
+        cursor.execute('PRAGMA busy_timeout = 0')
+    try:
+        _maintenance_steps(cursor, report, time_left)
+    except sqlite3.OperationalError as e:
+        if wait or 'locked' not in str(e):
+            raise
+    finally:
+        if not wait:
+            cursor.execute('PRAGMA busy_timeout = {:d}'.format(
+                int(DATABASE_TIMEOUT * 1000)))
+    return report
+
+
+def _maintenance_steps(cursor, report, time_left):
+    if time_left():
+        # Bound the work ANALYZE does per index on big tables.
+        cursor.execute('PRAGMA analysis_limit = 1000')
+        analyzed = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+        ).fetchall()
+        # PRAGMA optimize only reanalyzes tables whose statistics are
+        # stale, so a database which has never been analyzed needs a first
+        # ANALYZE.
+        cursor.execute('PRAGMA optimize' if analyzed else 'ANALYZE').fetchall()
+        report['analyzed'] = True
+
+    (auto_vacuum,), = cursor.execute('PRAGMA auto_vacuum').fetchall()
+    (free,), = cursor.execute('PRAGMA freelist_count').fetchall()
+    while auto_vacuum == 2 and free and time_left():
+        # Each step of the statement frees one page, and only
+        # executescript() steps a statement that returns no rows to the end.
+        cursor.executescript('PRAGMA incremental_vacuum({})'.format(
+            VACUUM_STEP_PAGES))
+        (left,), = cursor.execute('PRAGMA freelist_count').fetchall()
+        report['freed_pages'] += free - left
+        free = left
+
+    (journal_mode,), = cursor.execute('PRAGMA journal_mode').fetchall()
+    database = _State.engine.url.database
+    if journal_mode == 'wal' and database and time_left():
+        try:
+            wal_size = os.path.getsize(database + '-wal')
+        except OSError:
+            wal_size = 0
+        if wal_size > WAL_CHECKPOINT_BYTES:
+            # PASSIVE never waits for readers or writers.
+            (busy, _, _), = cursor.execute(
+                'PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+            report['checkpointed'] = not busy
+
+
 def execute(query, data=None):
     """
     Execute an arbitrary SQL query given by query, returning any
@@ -138,25 +515,30 @@ def execute(query, data=None):
     additional argument, which will be substituted into question marks in the
     query.
     """
+    flush()
     connection = _State.connection()
     _State.new_transaction()
 
     if data is None:
         data = []
 
-    result = connection.execute(query, data)
+    if _State.index_advisor:
+        _advise_indexes(connection, query, data)
 
-    _State.table = None
-    _State.metadata = None
-    try:
-        del _State.table_pending
-    except AttributeError:
-        pass
+    with _write_lock():
+        result = connection.execute(query, data)
+
+        _State.table = None
+        _State.metadata = None
+        try:
+            del _State.table_pending
+        except AttributeError:
+            pass
 
-    if not result.returns_rows:
-        return {u'data': [], u'keys': []}
+        if not result.returns_rows:
+            return {u'data': [], u'keys': []}
 
-    return {u'data': result.fetchall(), u'keys': list(result.keys())}
+        return {u'data': result.fetchall(), u'keys': list(result.keys())}
 
 
 def select(query, data=None):
@@ -164,18 +546,310 @@ def select(query, data=None):
     Perform a sql select statement with the given query (without 'select') and
     return any results as a list of OrderedDicts.
     """
+    flush()
     connection = _State.connection()
     _State.new_transaction()
     if data is None:
         data = []
 
+    if _State.index_advisor:
+        _advise_indexes(connection, 'select ' + query, data)
+
+    decoders = _result_decoders(connection, 'select ' + query)
     result = connection.execute('select ' + query, data)
+    keys = list(result.keys())
+    if not any(decoders):
+        return [dict(list(row.items())) for row in result]
+    return [dict(zip(keys, _decode_row(row, decoders))) for row in result]
 
-    rows = []
-    for row in result:
-        rows.append(dict(list(row.items())))
 
-    return rows
+def _decoder(declared_type, nest_json=True):
+    """
+    Return the function which decodes values of a JSON or compressed
+    column with the given declared type, or None, as textual queries
+    don't apply SQLAlchemy's result processors.
+    """
+    declared_type = (declared_type or u'').upper()
+    if declared_type == u'ZBLOB':
+        return ZBLOB().decode
+    if declared_type == u'ZTEXT':
+        return ZTEXT().decode
+    if nest_json and declared_type == u'JSON':
+        return _decode_json
+    return None
+
+
+def _declared_type(column):
+    if isinstance(column.type, ZBLOB):
+        return column.type.get_col_spec()
+    if isinstance(column.type, sqlalchemy.types.JSON):
+        return u'JSON'
+    return None
+
+
+def _table_decoders(table_name, keys, nest_json=True):
+    """
+    Return a decoder (or None) for each of the named columns of a table.
+    """
+    table = _State.metadata.tables.get(table_name)
+    types = dict((column.name, _declared_type(column))
+                 for column in (table.columns if table is not None else []))
+    return [_decoder(types.get(key), nest_json) for key in keys]
+
+
+def _decode_row(row, decoders):
+    return [value if decode is None else decode(value)
+            for value, decode in zip(row, decoders)]
+
+
+# Literals, quoted names and comments, which may contain anything, or else
+# a parameter.
+_SQL_TOKEN = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|\[[^\]]*\]|"""
+                        r"""`(?:[^`]|``)*`|--[^\n]*|/\*.*?(?:\*/|$))|"""
+                        r"""\?\d*|[:@$][A-Za-z_]\w*""", re.DOTALL)
+
+
+# Named so as not to clash with the user's views.
+_PROBE_VIEW = u'swresult_{}'.format(uuid.uuid4().hex)
+# Queries whose result types select() remembers.
+RESULT_TYPES_CACHE_SIZE = 1000
+
+
+def _result_decoders(connection, query):
+    """
+    Return a decoder (or None) for each result column of a SELECT
+    statement on the datastore, see _declared_types(). Statements which
+    name no table with columns to decode, nor any view, aren't checked.
+    """
+    if (_State.engine.dialect.name != 'sqlite' or
+            not _State.decoded_tables):
+        return []
+    types = _State.result_types.get(query)
+    if types is None:
+        if _State.view_names is None:
+            _State.view_names = [name for (name,) in connection.execute(
+                u"SELECT name FROM sqlite_master WHERE type = 'view' UNION "
+                u"SELECT name FROM sqlite_temp_master WHERE type = 'view'")]
+        names = list(_State.decoded_tables) + _State.view_names
+        if any(re.search(r'(?<![\w$]){}(?![\w$])'.format(re.escape(name)),
+                         query, re.IGNORECASE | re.UNICODE)
+               for name in names):
+            types = _declared_types(connection.connection, query)
+        else:
+            types = []
+        if len(_State.result_types) >= RESULT_TYPES_CACHE_SIZE:
+            _State.result_types.clear()
+        _State.result_types[query] = types
+    return [_decoder(declared_type) for declared_type in types]
+
+
+def _declared_types(dbapi_connection, query):
+    """
+    Return the declared type of the column that each result column of a
+    SELECT statement comes from, which SQLite reports as the columns of a
+    view of the statement. Expressions have none, and neither do the
+    columns of compound statements, whose origin could be any of their
+    parts.
+    """
+    # Views can't have parameters, and the types don't depend on them.
+    view = _SQL_TOKEN.sub(lambda match: match.group(1) or u'NULL', query)
+    bare = _SQL_TOKEN.sub(lambda match: match.group(1) and u"''" or u'?',
+                          query)
+    if re.search(r'\b(?:UNION|INTERSECT|EXCEPT)\b', bare, re.IGNORECASE):
+        return []
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(u'CREATE TEMP VIEW {} AS {}'.format(_PROBE_VIEW, view))
+    except sqlite3.Error:
+        # The statement itself will fail, or can't be a view.
+        return []
+    try:
+        return [column[2] for column in cursor.execute(
+            u'PRAGMA temp.table_info({})'.format(_PROBE_VIEW))]
+    finally:
+        cursor.execute(u'DROP VIEW temp.{}'.format(_PROBE_VIEW))
+
+
+def _decode_json(value):
+    if not isinstance(value, six.string_types):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def export(table_name, path, format='csv', compression=None, chunk_size=1000):
+    """
+    Write every row of the table to `path` as CSV ('csv'), JSON Lines
+    ('jsonl') or Parquet ('parquet'), and return the number of rows
+    written. Rows are fetched and written `chunk_size` at a time, so
+    memory use does not grow with the table. CSV and JSON Lines output
+    can be compressed with 'gzip' or 'bz2', Parquet with any codec
+    pyarrow supports. Blobs are written base64-encoded to CSV and JSON
+    Lines, and JSON columns as nested values to JSON Lines. Parquet
+    output needs pyarrow.
+
+    `path` may also be a file object (text for CSV and JSON Lines,
+    binary for Parquet) when no compression is asked for.
+    """
+    if format not in _EXPORTERS:
+        raise ValueError("Unknown export format {!r}, expected one of "
+                         "{}".format(format, ', '.join(sorted(_EXPORTERS))))
+    if format != 'parquet' and compression not in (None, 'gzip', 'bz2'):
+        raise ValueError("Unknown compression {!r}".format(compression))
+
+    flush()
+    connection = _State.connection()
+    _State.new_transaction()
+    preparer = _State.engine.dialect.identifier_preparer
+    result = connection.execute(
+        u'SELECT * FROM {}'.format(preparer.quote(table_name)))
+    keys = list(result.keys())
+    # JSON columns are written as nested values to JSON Lines.
+    decoders = _table_decoders(table_name, keys, nest_json=format == 'jsonl')
+
+    def chunks():
+        while True:
+            chunk = result.fetchmany(chunk_size)
+            if not chunk:
+                break
+            if any(decoders):
+                chunk = [_decode_row(row, decoders) for row in chunk]
+            yield chunk
+
+    try:
+        return _EXPORTERS[format](table_name, keys, chunks(), path,
+                                  compression)
+    finally:
+        result.close()
+
+
+class _UTF8Writer(object):
+
+    """
+    A text file over a binary one, for Python 2, whose csv module writes
+    bytes and whose io.TextIOWrapper can't wrap a BZ2File.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, text):
+        if isinstance(text, six.text_type):
+            text = text.encode('utf-8')
+        self.f.write(text)
+
+
+@contextlib.contextmanager
+def _open_export(path, compression):
+    """
+    Open a text file for export, compressing it if asked to.
+    """
+    if hasattr(path, 'write'):
+        if compression is not None:
+            raise ValueError("Compression needs a file name, not a file")
+        yield path
+        return
+    opener = {None: io.open, 'gzip': gzip.GzipFile,
+              'bz2': bz2.BZ2File}[compression]
+    with contextlib.closing(opener(path, 'wb')) as f:
+        if six.PY2:
+            yield _UTF8Writer(f)
+            return
+        text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+        try:
+            yield text
+        finally:
+            text.flush()
+            text.detach()
+
+
+def _export_value(value):
+    # Blobs are buffers on Python 2.
+    if isinstance(value, (bytes, bytearray, memoryview, sqlite3.Binary)):
+        return base64.b64encode(bytes(value)).decode('ascii')
+    return value
+
+
+def _csv_value(value):
+    value = _export_value(value)
+    if six.PY2 and isinstance(value, six.text_type):
+        # Python 2's csv module only writes bytes.
+        return value.encode('utf-8')
+    return value
+
+
+def _export_csv(table_name, keys, chunks, path, compression):
+    count = 0
+    with _open_export(path, compression) as f:
+        writer = csv.writer(f)
+        writer.writerow([_csv_value(key) for key in keys])
+        for chunk in chunks:
+            writer.writerows([_csv_value(value) for value in row]
+                             for row in chunk)
+            count += len(chunk)
+    return count
+
+
+def _export_jsonl(table_name, keys, chunks, path, compression):
+    count = 0
+    with _open_export(path, compression) as f:
+        for chunk in chunks:
+            f.write(u''.join(
+                json.dumps(dict(zip(keys, row)), default=_export_value,
+                           ensure_ascii=False) + u'\n'
+                for row in chunk))
+            count += len(chunk)
+    return count
+
+
+def _export_parquet(table_name, keys, chunks, path, compression):
+    import pyarrow
+    import pyarrow.parquet
+
+    types = [
+        (sqlalchemy.types.Boolean, pyarrow.bool_(), bool),
+        (sqlalchemy.types.Integer, pyarrow.int64(), int),
+        (sqlalchemy.types.Float, pyarrow.float64(), float),
+        (sqlalchemy.types.LargeBinary, pyarrow.binary(), bytes),
+        (ZTEXT, pyarrow.string(), unicode),
+        (ZBLOB, pyarrow.binary(), bytes),
+    ]
+    _State.reflect_metadata()
+    columns = sqlalchemy.Table(table_name, _State.metadata,
+                               extend_existing=True).columns
+    fields, converters = [], []
+    for key in keys:
+        column_type = columns[key].type if key in columns else None
+        for sql_type, arrow_type, convert in types:
+            if isinstance(column_type, sql_type):
+                break
+        else:
+            arrow_type, convert = pyarrow.string(), unicode
+        fields.append(pyarrow.field(key, arrow_type))
+        converters.append(convert)
+    schema = pyarrow.schema(fields)
+
+    options = {} if compression is None else {'compression': compression}
+    count = 0
+    with pyarrow.parquet.ParquetWriter(path, schema, **options) as writer:
+        for chunk in chunks:
+            arrays = [
+                pyarrow.array([None if row[i] is None else convert(row[i])
+                               for row in chunk], type=field.type)
+                for i, (field, convert) in enumerate(zip(fields, converters))]
+            writer.write_table(
+                pyarrow.Table.from_arrays(arrays, schema=schema))
+            count += len(chunk)
+    return count
+
+
+_EXPORTERS = {
+    'csv': _export_csv,
+    'jsonl': _export_jsonl,
+    'parquet': _export_parquet,
+}
 
 
 def save(unique_keys, data, table_name='swdata'):
@@ -184,12 +858,10 @@ def save(unique_keys, data, table_name='swdata'):
     (which defaults to 'swdata'). The data must be a mapping
     or an iterable of mappings. Unique keys is a list of keys that exist
     for all rows and for which a unique index will be created.
-    """
-
-    _set_table(table_name)
-
-    connection = _State.connection()
 
+    In coordinated mode (SCRAPERWIKI_COORDINATED_WRITES) rows are
+    buffered and written by flush().
+    """
     if isinstance(data, Mapping):
         # Is a single datum
         data = [data]
@@ -197,22 +869,185 @@ def save(unique_keys, data, table_name='swdata'):
         raise TypeError("Data must be a single mapping or an iterable "
                         "of mappings")
 
-    insert = _State.table.insert(prefixes=['OR REPLACE'])
+    if _State.coordinated:
+        _buffer(unique_keys, data, table_name)
+    else:
+        _save_rows(unique_keys, data, table_name)
+
+
+def _buffer(unique_keys, data, table_name):
+    """
+    Queue rows for flush(), flushing once there are WRITE_BATCH_SIZE of
+    them or SECONDS_BETWEEN_COMMIT have passed.
+    """
+    _State.connection()
+    rows = []
+    for row in data:
+        if not isinstance(row, Mapping):
+            raise TypeError("Elements of data must be mappings, got {}".format(
+                            type(row)))
+        # Fail here, rather than in whichever call flushes the row.
+        for name, value in row.items():
+            _check_storable(name, value)
+        # Copy, as scrapers often reuse one dict for every row.
+        rows.append(dict(row))
+
+    key = (table_name, list(unique_keys))
+    if _State.pending and _State.pending[-1][:2] == key:
+        _State.pending[-1][2].extend(rows)
+    else:
+        _State.pending.append(key + (rows,))
+    _State.pending_rows += len(rows)
+
+    if (_State.pending_rows >= WRITE_BATCH_SIZE or
+            time.time() - _State.last_flush > SECONDS_BETWEEN_COMMIT):
+        flush()
+
+
+# Types of the values the sqlite3 driver can store.
+_STORABLE = six.integer_types + (float, six.text_type, bytes, bytearray,
+                                 sqlite3.Binary)
+# Bind processors for each Python type, see _check_storable().
+_processors = {}
+
+
+def _check_storable(name, value):
+    """
+    Raise TypeError unless `value` can be saved to a column of its type.
+    """
+    if value is None:
+        return
+    try:
+        process = _processors[type(value)]
+    except KeyError:
+        dialect = _State.engine.dialect
+        column_type = get_column_type(value)()
+        process = column_type.dialect_impl(dialect).bind_processor(dialect)
+        _processors[type(value)] = process
+    if not isinstance(value if process is None else process(value),
+                      _STORABLE):
+        raise TypeError("Value of column {!r} can't be saved: type {} is "
+                        "not supported".format(name, type(value).__name__))
+
+
+def flush():
+    """
+    Write any rows buffered by save() and commit. In coordinated mode
+    the rows are written in batches of at most WRITE_BATCH_SIZE, each
+    while holding the write lock and committed on its own. If a batch
+    fails it is rolled back and dropped, the error is raised, and the
+    rows after it stay buffered.
+    """
+    if _State.flushing:
+        # Called while writing a batch, by create_index() for instance.
+        return
+    _State.last_flush = time.time()
+    if _State.pending:
+        # So that a failed batch rolls back nothing but itself.
+        _State.connection()
+        _State.new_transaction()
+    while _State.pending:
+        table_name, unique_keys, rows = _State.pending[0]
+        batch = rows[:WRITE_BATCH_SIZE]
+        del rows[:WRITE_BATCH_SIZE]
+        _State.pending_rows -= len(batch)
+        if not rows:
+            _State.pending.pop(0)
+        _State.flushing = True
+        try:
+            with _write_lock():
+                _save_rows(unique_keys, batch, table_name)
+        except Exception:
+            _rollback()
+            raise
+        finally:
+            _State.flushing = False
+        _State.new_transaction()
+    if _State._transaction is not None:
+        _State.new_transaction()
+
+
+def _rollback():
+    """
+    Roll back the open transaction, and forget the schema it may have
+    changed.
+    """
+    if _State._transaction is not None:
+        _State._transaction.rollback()
+        _State._transaction = None
+    _State.table = None
+    _State.metadata = None
+    try:
+        del _State.table_pending
+    except AttributeError:
+        pass
+
+
+def _save_rows(unique_keys, data, table_name):
+    """
+    Write rows to the table, growing its schema as needed.
+    """
+    _set_table(table_name)
+
+    connection = _State.connection()
+
+    if _State.use_sqlite3():
+        cursor = connection.connection.cursor()
+    else:
+        insert = _State.table.insert(prefixes=['OR REPLACE'])
     for row in data:
         if not isinstance(row, Mapping):
             raise TypeError("Elements of data must be mappings, got {}".format(
                             type(row)))
         fit_row(connection, row, unique_keys)
-        connection.execute(insert.values(row))
+        if _State.use_sqlite3():
+            columns = tuple(row.keys())
+            statement, processors = _insert_statement(columns)
+            cursor.execute(statement, [
+                value if process is None else process(value)
+                for value, process in zip(row.values(), processors)])
+        else:
+            connection.execute(insert.values(row))
     _State.check_last_committed()
 
 
+def _insert_statement(columns):
+    """
+    Return the INSERT OR REPLACE statement for the given columns of the
+    current table, and the bind processors for their values. Both are
+    cached on the table, so SQLAlchemy is only consulted once per set of
+    columns.
+    """
+    cache = _State.table.info.setdefault('scraperwiki_inserts', {})
+    if columns in cache:
+        return cache[columns]
+
+    dialect = _State.engine.dialect
+    preparer = dialect.identifier_preparer
+    statement = u'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+        preparer.format_table(_State.table),
+        u', '.join(preparer.quote(column) for column in columns),
+        u', '.join([u'?'] * len(columns)))
+    processors = [
+        _State.table.columns[column].type.dialect_impl(dialect)
+                                         .bind_processor(dialect)
+        for column in columns]
+
+    cache[columns] = statement, processors
+    return cache[columns]
+
+
 def _set_table(table_name):
     """
     Specify the table to work on.
     """
     _State.connection()
     _State.reflect_metadata()
+    if _State.coordinated:
+        # Another process may have created or altered the table since
+        # it was last reflected.
+        _State.reflect_metadata(extend_existing=True,
+                                only=lambda name, _: name == table_name)
     _State.table = sqlalchemy.Table(table_name, _State.metadata,
                                     extend_existing=True)
 
@@ -226,6 +1061,7 @@ def show_tables():
     """
     Return the names of the tables currently in the database.
     """
+    flush()
     _State.connection()
     _State.reflect_metadata()
     metadata = _State.metadata
@@ -240,6 +1076,12 @@ def save_var(name, value):
     Save a variable to the table specified by _State.vars_table_name. Key is
     the name of the variable, and value is the value.
     """
+    flush()
+    with _write_lock():
+        _save_var(name, value)
+
+
+def _save_var(name, value):
     connection = _State.connection()
     _State.reflect_metadata()
 
@@ -254,16 +1096,24 @@ def save_var(name, value):
     vars_table.create(bind=connection, checkfirst=True)
 
     column_type = get_column_type(value)
+    type_name = column_type.__visit_name__.lower()
 
     if column_type == sqlalchemy.types.LargeBinary:
         value_blob = value
+    elif column_type == JSON:
+        value_blob = _json_dumps(value).encode('utf-8')
+    elif issubclass(column_type, ZBLOB):
+        if column_type.text:
+            value = value.encode('utf-8')
+        value_blob = _compress(bytes(value))
+        type_name = column_type.__name__.lower()
     else:
         value_blob = unicode(value).encode('utf-8')
 
     values = dict(name=name,
                   value_blob=value_blob,
                   # value_blob=Blob(value),
-                  type=column_type.__visit_name__.lower())
+                  type=type_name)
 
     vars_table.insert(prefixes=['OR REPLACE']).values(**values).execute()
 
@@ -273,12 +1123,16 @@ def get_var(name, default=None):
     Returns the variable with the provided key from the
     table specified by _State.vars_table_name.
     """
+    flush()
     alchemytypes = {"text": lambda x: x.decode('utf-8'),
                     "big_integer": lambda x: int(x),
                     "date": lambda x: x.decode('utf-8'),
                     "datetime": lambda x: x.decode('utf-8'),
                     "float": lambda x: float(x),
                     "large_binary": lambda x: x,
+                    "json": lambda x: json.loads(x.decode('utf-8')),
+                    "zblob": lambda x: _decompress(x),
+                    "ztext": lambda x: _decompress(x).decode('utf-8'),
                     "boolean": lambda x: x==b'True'}
 
     connection = _State.connection()
@@ -306,17 +1160,27 @@ def get_var(name, default=None):
     return var.decode('utf-8')
 
 
-def create_index(column_names, unique=False):
+def create_index(column_names, unique=False, table_name=None):
     """
     Create a new index of the columns in column_names, where column_names is
     a list of strings. If unique is True, it will be a
-    unique index.
+    unique index. The index is on the current table unless table_name
+    is given. A name such as "data$.address.city" indexes that JSON path
+    within the column "data", through a generated column of that name.
     """
+    flush()
     connection = _State.connection()
     _State.reflect_metadata()
-    table_name = _State.table.name
+    if table_name is None:
+        table = _State.table
+    else:
+        table = sqlalchemy.Table(table_name, _State.metadata,
+                                 extend_existing=True)
+    table_name = table.name
 
-    table = _State.table
+    for column_name in column_names:
+        if column_name not in table.columns and _JSON_PATH.match(column_name):
+            _add_json_path_column(connection, table, column_name)
 
     index_name = re.sub(r'[^a-zA-Z0-9]', '', table_name) + '_'
     index_name += '_'.join(re.sub(r'[^a-zA-Z0-9]', '', x)
@@ -332,7 +1196,275 @@ def create_index(column_names, unique=False):
     current_indices = [x.name for x in table.indexes]
     index = sqlalchemy.schema.Index(index_name, *columns, unique=unique)
     if index.name not in current_indices:
-        index.create(bind=_State.engine)
+        index.create(bind=connection)
+
+
+# A column name followed by a JSON path, such as "data$.items[0].name".
+_JSON_PATH = re.compile(r'^(.+?)(\$(?:[.\[].*)?)$')
+
+
+def _add_json_path_column(connection, table, name):
+    """
+    Add a virtual generated column holding the value at a JSON path, so
+    that it can be indexed and queried by name.
+    """
+    if sqlite3.sqlite_version_info < (3, 31, 0):
+        raise SqliteError("Indexing JSON paths needs SQLite 3.31 or later "
+                          "for generated columns, this is {}".format(
+                              sqlite3.sqlite_version))
+    column_name, path = _JSON_PATH.match(name).groups()
+    preparer = _State.engine.dialect.identifier_preparer
+    # Generated column expressions can't take parameters.
+    connection.execute(
+        u"ALTER TABLE {} ADD COLUMN {} GENERATED ALWAYS AS "
+        u"(json_extract({}, '{}')) VIRTUAL".format(
+            preparer.format_table(table), preparer.quote(name),
+            preparer.quote(column_name), path.replace(u"'", u"''")))
+    _State.reflect_metadata(extend_existing=True,
+                            only=lambda table_name, _: table_name == table.name)
+
+
+def track_changes(table_name='swdata'):
+    """
+    Record every insert and update of rows in the given table, so that
+    changes_since() can return just those rows. Rows already in the table
+    are recorded as changed now. Tables created by save() are tracked
+    automatically when SCRAPERWIKI_TRACK_CHANGES is set.
+    """
+    flush()
+    with _write_lock():
+        _track_changes(_State.connection(), table_name, backfill=True)
+    _State.new_transaction()
+
+
+def _track_changes(connection, table_name, backfill=False):
+    """
+    Create the changes table and the triggers which fill it in from the
+    given table, in the same transaction as the change itself. Each
+    changed row keeps a single entry, whose version is bumped on every
+    change.
+    """
+    preparer = _State.engine.dialect.identifier_preparer
+    changes = preparer.quote(_State.changes_table_name)
+    table = preparer.quote(table_name)
+    # Triggers can't take parameters.
+    name = u"'{}'".format(table_name.replace(u"'", u"''"))
+
+    connection.execute(u"""
+        CREATE TABLE IF NOT EXISTS {} (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            UNIQUE (table_name, row_id))""".format(changes))
+
+    forget = u'DELETE FROM {} WHERE table_name = {} AND row_id = {}.rowid;'
+    record = u'INSERT INTO {} (table_name, row_id) VALUES ({}, NEW.rowid);'
+    triggers = [
+        ('insert', 'AFTER INSERT', [forget.format(changes, name, 'NEW'),
+                                    record.format(changes, name)]),
+        ('update', 'AFTER UPDATE', [forget.format(changes, name, 'OLD'),
+                                    forget.format(changes, name, 'NEW'),
+                                    record.format(changes, name)]),
+        ('delete', 'AFTER DELETE', [forget.format(changes, name, 'OLD')])]
+    # INSERT OR REPLACE deletes the rows it replaces without firing delete
+    # triggers, so forget them before the insert, going by the unique keys.
+    replaced = [u' AND '.join(u'{0} IS NEW.{0}'.format(preparer.quote(column))
+                              for column in columns)
+                for columns in _unique_keys(connection, table_name)]
+    if replaced:
+        triggers.append(('replace', 'BEFORE INSERT', [
+            u'DELETE FROM {} WHERE table_name = {} AND row_id IN '
+            u'(SELECT rowid FROM {} WHERE {});'.format(
+                changes, name, table, u' OR '.join(
+                    u'({})'.format(match) for match in replaced))]))
+    for event, when, body in triggers:
+        trigger = preparer.quote(u'{}_{}_{}'.format(
+            _State.changes_table_name, table_name, event))
+        connection.execute(u'CREATE TRIGGER IF NOT EXISTS {} {} ON {} '
+                           u'BEGIN {} END'.format(trigger, when, table,
+                                                  u' '.join(body)))
+
+    if backfill:
+        connection.execute(
+            u'INSERT OR IGNORE INTO {} (table_name, row_id) '
+            u'SELECT ?, rowid FROM {} ORDER BY rowid'.format(changes, table),
+            [table_name])
+
+
+def _unique_keys(connection, table_name):
+    """
+    Return the columns of each unique index of the table.
+    """
+    preparer = _State.engine.dialect.identifier_preparer
+    keys = []
+    for index in connection.execute(u'PRAGMA index_list({})'.format(
+            preparer.quote(table_name))).fetchall():
+        if not index[2]:
+            continue
+        columns = [column[2] for column in connection.execute(
+            u'PRAGMA index_info({})'.format(preparer.quote(index[1])))]
+        # Indexes on expressions have unnamed columns.
+        if columns and None not in columns:
+            keys.append(columns)
+    return keys
+
+
+def changes_since(table_name='swdata', token=0, chunk_size=1000):
+    """
+    Iterate over the rows of a tracked table (see track_changes()) which
+    were inserted or updated after `token`, oldest change first, as
+    (token, row) pairs. Pass the last token seen to a later call to pick
+    up where it left off; 0 returns every tracked row. Each changed row is
+    returned once, however often it changed. Deleted rows are not
+    reported.
+    """
+    flush()
+    connection = _State.connection()
+    _State.new_transaction()
+    preparer = _State.engine.dialect.identifier_preparer
+
+    result = connection.execute(
+        u'SELECT changes.version, data.* FROM {} AS changes '
+        u'JOIN {} AS data ON data.rowid = changes.row_id '
+        u'WHERE changes.table_name = ? AND changes.version > ? '
+        u'ORDER BY changes.version'.format(
+            preparer.quote(_State.changes_table_name),
+            preparer.quote(table_name)),
+        [table_name, token])
+    keys = list(result.keys())[1:]
+    decoders = _table_decoders(table_name, keys)
+    try:
+        while True:
+            chunk = result.fetchmany(chunk_size)
+            if not chunk:
+                break
+            for row in chunk:
+                yield row[0], dict(zip(keys, _decode_row(row[1:], decoders)))
+    finally:
+        result.close()
+
+
+_EQUALITY_OPERATORS = ('=', '==', 'IN', 'IS')
+_COMPARISON = re.compile(r'\s*(==|=|<=|>=|<>|!=|<|>|IN\b|IS\b|BETWEEN\b)',
+                         re.IGNORECASE)
+# The text of each WHERE, ON or HAVING clause, up to the next clause.
+_FILTER_CLAUSE = re.compile(
+    r'\b(?:WHERE|ON|HAVING)\b(.*?)(?=\b(?:WHERE|ON|HAVING|GROUP\s+BY|'
+    r'ORDER\s+BY|LIMIT|WINDOW|UNION|INTERSECT|EXCEPT|RETURNING|JOIN|NATURAL|'
+    r'LEFT|RIGHT|FULL|INNER|CROSS)\b|$)', re.IGNORECASE | re.DOTALL)
+
+
+def _advise_indexes(connection, query, data):
+    """
+    Ask SQLite how it will run the query, and record an index for each
+    table it has to scan in full on a column that the query filters on,
+    or for which it would build a temporary automatic index. Indexes are
+    only created for SELECT statements.
+    """
+    try:
+        plan = connection.execute(u'EXPLAIN QUERY PLAN ' + query,
+                                  data).fetchall()
+    except sqlalchemy.exc.SQLAlchemyError:
+        return
+    if _State.metadata is None:
+        _State.reflect_metadata()
+    tables = _State.metadata.tables
+
+    for row in plan:
+        detail = row[-1]
+        scan = re.match(r'SCAN (?:TABLE )?(.+?)(?: AS (.+))?$', detail)
+        automatic = re.match(r'SEARCH (?:TABLE )?(.+?)(?: AS (.+))? USING '
+                             r'AUTOMATIC (?:PARTIAL )?(?:COVERING )?INDEX '
+                             r'\((.+)\)$', detail)
+        if scan and ' USING ' not in detail:
+            name = scan.group(2) or scan.group(1)
+        elif automatic:
+            name = automatic.group(2) or automatic.group(1)
+        else:
+            continue
+
+        table_name = _resolve_table(query, name, tables)
+        if table_name is None:
+            continue
+        if automatic:
+            columns = [re.sub(r'[=<>]+\?$', '', term)
+                       for term in automatic.group(3).split(' AND ')]
+        else:
+            columns = _filtered_columns(query, name,
+                                        tables[table_name].columns.keys())
+        if not columns:
+            continue
+
+        key = (table_name, tuple(columns))
+        hits = _State.index_suggestions.get(key, 0)
+        _State.index_suggestions[key] = hits + 1
+        if (_State.index_advisor == 'create' and hits == 0 and
+                re.match(r'\s*(?:SELECT|WITH)\b', query, re.IGNORECASE)):
+            create_index(columns, table_name=table_name)
+
+
+def _resolve_table(query, name, tables):
+    """
+    Return the table that `name`, a table name or alias in the query,
+    refers to.
+    """
+    if name in tables:
+        return name
+    for table_name in tables:
+        alias = r'[\["`]?{}[\]"`]?\s+(?:AS\s+)?{}\b'.format(
+            re.escape(table_name), re.escape(name))
+        if re.search(alias, query, re.IGNORECASE):
+            return table_name
+    return None
+
+
+def _filtered_columns(query, name, column_names):
+    """
+    Return the columns of the table called `name` in the query that its
+    WHERE or ON clauses compare with something: equality comparisons
+    first, followed by at most one range comparison, as an index can
+    serve no more.
+    """
+    clauses = [match.span(1) for match in _FILTER_CLAUSE.finditer(query)]
+    found = []
+    for column_name in column_names:
+        pattern = r'(?<![\w.])(?:{}\.)?[\["`]?{}[\]"`]?'.format(
+            re.escape(name), re.escape(column_name))
+        for match in re.finditer(pattern, query, re.IGNORECASE):
+            if not any(start <= match.start() < end for start, end in clauses):
+                continue
+            operator = _COMPARISON.match(query, match.end())
+            if operator:
+                equality = operator.group(1).upper() in _EQUALITY_OPERATORS
+                found.append((match.start(), equality, column_name))
+                break
+    found.sort()
+    columns = [column for _, equality, column in found if equality]
+    columns += [column for _, equality, column in found if not equality][:1]
+    return columns
+
+
+def index_suggestions():
+    """
+    Return the indexes recorded by the index advisor (see
+    SCRAPERWIKI_INDEX_ADVISOR) which don't exist yet, most wanted first,
+    as dicts with 'table', 'columns' and 'hits' keys.
+    """
+    _State.connection()
+    _State.reflect_metadata()
+    suggestions = []
+    for (table_name, columns), hits in _State.index_suggestions.items():
+        table = _State.metadata.tables.get(table_name)
+        if table is None:
+            continue
+        existing = [[column.name for column in index.columns]
+                    for index in table.indexes]
+        if any(index[:len(columns)] == list(columns) for index in existing):
+            continue
+        suggestions.append({'table': table_name, 'columns': list(columns),
+                            'hits': hits})
+    suggestions.sort(key=lambda suggestion: -suggestion['hits'])
+    return suggestions
 
 
 def fit_row(connection, row, unique_keys):
@@ -362,9 +1494,12 @@ def create_table(unique_keys):
     Save the table currently waiting to be created.
     """
     _State.new_transaction()
-    _State.table.create(bind=_State.engine, checkfirst=True)
+    # Created on the module's connection, which set auto_vacuum.
+    _State.table.create(bind=_State._connection, checkfirst=True)
     if unique_keys != []:
         create_index(unique_keys, unique=True)
+    if _State.track_changes:
+        _track_changes(_State.connection(), _State.table.name)
     _State.table_pending = False
     _State.reflect_metadata()
 
@@ -373,8 +1508,19 @@ def add_column(connection, column):
     """
     Add a column to the current table.
     """
-    stmt = alembic.ddl.base.AddColumn(_State.table.name, column)
-    connection.execute(stmt)
+    if _State.use_sqlite3():
+        dialect = _State.engine.dialect
+        preparer = dialect.identifier_preparer
+        connection.execute(u'ALTER TABLE {} ADD COLUMN {} {}'.format(
+            preparer.format_table(_State.table),
+            preparer.format_column(column),
+            column.type.compile(dialect=dialect)))
+    else:
+        # alembic is slow to import and only needed for schema changes.
+        import alembic.ddl
+
+        stmt = alembic.ddl.base.AddColumn(_State.table.name, column)
+        connection.execute(stmt)
     _State.reflect_metadata()
 
 
@@ -396,6 +1542,7 @@ def drop():
     Drop the current table if it exists
     """
     # Ensure the connection is up
+    flush()
     _State.connection()
     _State.table.drop(checkfirst=True)
     _State.metadata.remove(_State.table)
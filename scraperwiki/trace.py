@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# trace.py
+
+'''
+Timing of scrape(), pdftoxml() and status().
+
+Each call made while a hook is installed produces an event, a dict with
+the "operation", the "host" it talked to, its "duration" and "bytes",
+"pages" for PDFs, any "error", and the seconds spent in each of its
+"phases": "dns", "connect", "tls", "wait" (for the response headers) and
+"download" for HTTP requests, "convert" for PDFs.
+
+    from scraperwiki import trace
+    trace.add_hook(lambda event: print(event))
+
+An Aggregator is a hook which keeps latency percentiles for each host and
+phase. Setting SCRAPERWIKI_TRACE, or calling enable(), installs one which
+prints its summary when the process exits.
+'''
+from __future__ import absolute_import, print_function
+
+import atexit
+import contextlib
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+TRACE = bool(os.environ.get("SCRAPERWIKI_TRACE"))
+# Samples kept for each host and phase; beyond this the percentiles are
+# estimated from a random sample.
+MAX_SAMPLES = 10000
+
+_clock = getattr(time, 'perf_counter', time.time)
+_hooks = []
+_local = threading.local()
+_opener = None
+_aggregator = None
+
+
+def add_hook(hook):
+    """
+    Call hook(event) after every traced operation.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+@contextlib.contextmanager
+def span(operation, url=None, **fields):
+    """
+    Time the operation in the block and pass its event to the hooks. The
+    block gets the event, or None when there are no hooks.
+    """
+    if not _hooks:
+        yield None
+        return
+    import six.moves.urllib.parse
+    event = dict(operation=operation, phases={}, bytes=0, error=None,
+                 host=six.moves.urllib.parse.urlsplit(url).netloc
+                 if url else None)
+    event.update(fields)
+    outer = getattr(_local, 'event', None)
+    _local.event = event
+    start = _clock()
+    try:
+        yield event
+    except Exception as e:
+        event['error'] = repr(e)
+        raise
+    finally:
+        event['duration'] = _clock() - start
+        _local.event = outer
+        for hook in list(_hooks):
+            hook(event)
+
+
+def phase(name, seconds, nbytes=0):
+    """
+    Add to the time spent in a phase of the current operation.
+    """
+    event = getattr(_local, 'event', None)
+    if event is not None:
+        event['phases'][name] = event['phases'].get(name, 0) + seconds
+        event['bytes'] += nbytes
+
+
+def urlopen(request):
+    """
+    Open a URL like urllib's urlopen, timing the phases of the request if
+    it is being traced.
+    """
+    global _opener
+    import six.moves.urllib.request
+    if getattr(_local, 'event', None) is None:
+        return six.moves.urllib.request.urlopen(request)
+    if _opener is None:
+        # Built on first use, as http.client and ssl are slow to import.
+        from ._tracehttp import build_opener
+        _opener = build_opener()
+    return _opener.open(request)
+
+
+def _percentile(values, percent):
+    """
+    Return the nearest-rank percentile of sorted values.
+    """
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(0, min(len(values), rank) - 1)]
+
+
+class Aggregator(object):
+
+    """
+    A hook which summarises events by operation and host: how many there
+    were, how many failed, the bytes transferred, the conversion time per
+    PDF page, and the 50th, 90th and 99th percentiles of the time taken in
+    total and in each phase.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Keyed by (operation, host).
+        self.totals = {}
+        # Keyed by (operation, host, phase).
+        self.samples = {}
+        self.seen = {}
+
+    def __call__(self, event):
+        key = (event['operation'], event['host'])
+        with self.lock:
+            totals = self.totals.setdefault(
+                key, dict(count=0, errors=0, bytes=0, pages=0, seconds=0.0,
+                          convert_seconds=0.0))
+            totals['count'] += 1
+            totals['errors'] += event['error'] is not None
+            totals['bytes'] += event['bytes']
+            totals['pages'] += event.get('pages') or 0
+            totals['seconds'] += event['duration']
+            totals['convert_seconds'] += event['phases'].get('convert', 0)
+            phases = dict(event['phases'], total=event['duration'])
+            for name, seconds in phases.items():
+                self._sample(key + (name,), seconds)
+
+    def _sample(self, key, seconds):
+        # Reservoir sampling keeps a uniform sample of every event.
+        samples = self.samples.setdefault(key, [])
+        self.seen[key] = seen = self.seen.get(key, 0) + 1
+        if len(samples) < MAX_SAMPLES:
+            samples.append(seconds)
+        else:
+            index = random.randrange(seen)
+            if index < MAX_SAMPLES:
+                samples[index] = seconds
+
+    def summary(self):
+        """
+        Return a dict, keyed by (operation, host), of dicts of totals and
+        of percentiles for each phase.
+        """
+        with self.lock:
+            summary = {}
+            for key, totals in self.totals.items():
+                summary[key] = dict(totals, phases={})
+                if totals['pages']:
+                    summary[key]['seconds_per_page'] = (
+                        totals['convert_seconds'] / totals['pages'])
+            for (operation, host, name), samples in self.samples.items():
+                samples = sorted(samples)
+                summary[(operation, host)]['phases'][name] = dict(
+                    (p, _percentile(samples, int(p[1:])))
+                    for p in ('p50', 'p90', 'p99'))
+            return summary
+
+    def report(self, file=None):
+        """
+        Print the summary.
+        """
+        file = file or sys.stderr
+        summary = self.summary()
+        order = ('total', 'dns', 'connect', 'tls', 'wait', 'download',
+                 'convert')
+        for (operation, host), totals in sorted(
+                summary.items(), key=lambda item: (item[0][0],
+                                                   item[0][1] or '')):
+            line = '{} {}: {} calls, {} errors, {} bytes'.format(
+                operation, host or '-', totals['count'], totals['errors'],
+                totals['bytes'])
+            if 'seconds_per_page' in totals:
+                line += ', {:.3f}s per page'.format(totals['seconds_per_page'])
+            print(line, file=file)
+            phases = totals['phases']
+            for name in sorted(phases, key=lambda name: (
+                    order.index(name) if name in order else len(order), name)):
+                print('  {:<9} p50 {:8.1f}ms  p90 {:8.1f}ms  p99 {:8.1f}ms'
+                      .format(name, *[phases[name][p] * 1000
+                                      for p in ('p50', 'p90', 'p99')]),
+                      file=file)
+
+
+def enable():
+    """
+    Install the built-in Aggregator, which reports when the process
+    exits, and return it.
+    """
+    global _aggregator
+    if _aggregator is None:
+        _aggregator = Aggregator()
+        add_hook(_aggregator)
+        atexit.register(_aggregator.report)
+    return _aggregator
+
+
+if TRACE:
+    enable()
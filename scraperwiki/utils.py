@@ -11,17 +11,21 @@ from __future__ import absolute_import
 
 import os
 import sys
+import time
 import warnings
 import tempfile
 import six.moves.urllib.parse
 import six.moves.urllib.request
-import requests
 
+from . import trace
 
-def scrape(url, params=None, user_agent=None):
+
+def scrape(url, params=None, user_agent=None, scheduler=None):
     '''
     Scrape a URL optionally with parameters.
     This is effectively a wrapper around urllib2.urlopen.
+    With a scraperwiki.scheduler.Scheduler (or SCRAPERWIKI_RATE_LIMIT set)
+    requests are rate limited per host and retried when throttled.
     '''
 
     headers = {}
@@ -31,32 +35,46 @@ def scrape(url, params=None, user_agent=None):
 
     data = params and six.moves.urllib.parse.urlencode(params) or None
     req = six.moves.urllib.request.Request(url, data=data, headers=headers)
-    f = six.moves.urllib.request.urlopen(req)
 
-    text = f.read()
-    f.close()
+    if scheduler is None and os.environ.get("SCRAPERWIKI_RATE_LIMIT"):
+        from .scheduler import default
+        scheduler = default()
+
+    with trace.span('scrape', url):
+        if scheduler is not None:
+            return scheduler.fetch(req, urlopen=trace.urlopen)
+
+        f = trace.urlopen(req)
+
+        text = f.read()
+        f.close()
 
     return text
 
 
 def pdftoxml(pdfdata, options=""):
     """converts pdf file to xml file"""
-    pdffout = tempfile.NamedTemporaryFile(suffix='.pdf')
-    pdffout.write(pdfdata)
-    pdffout.flush()
-
-    xmlin = tempfile.NamedTemporaryFile(mode='r', suffix='.xml')
-    tmpxml = xmlin.name  # "temph.xml"
-    cmd = 'pdftohtml -xml -nodrm -zoom 1.5 -enc UTF-8 -noframes %s "%s" "%s"' % (
-        options, pdffout.name, os.path.splitext(tmpxml)[0])
-    # can't turn off output, so throw away even stderr yeuch
-    cmd = cmd + " >/dev/null 2>&1"
-    os.system(cmd)
-
-    pdffout.close()
-    #xmlfin = open(tmpxml)
-    xmldata = xmlin.read()
-    xmlin.close()
+    with trace.span('pdftoxml', bytes=len(pdfdata)) as event:
+        pdffout = tempfile.NamedTemporaryFile(suffix='.pdf')
+        pdffout.write(pdfdata)
+        pdffout.flush()
+
+        xmlin = tempfile.NamedTemporaryFile(mode='r', suffix='.xml')
+        tmpxml = xmlin.name  # "temph.xml"
+        cmd = 'pdftohtml -xml -nodrm -zoom 1.5 -enc UTF-8 -noframes %s "%s" "%s"' % (
+            options, pdffout.name, os.path.splitext(tmpxml)[0])
+        # can't turn off output, so throw away even stderr yeuch
+        cmd = cmd + " >/dev/null 2>&1"
+        start = time.time()
+        os.system(cmd)
+        trace.phase('convert', time.time() - start)
+
+        pdffout.close()
+        #xmlfin = open(tmpxml)
+        xmldata = xmlin.read()
+        xmlin.close()
+        if event is not None:
+            event['pages'] = xmldata.count('<page ')
     return xmldata.decode('utf-8')
 
 
@@ -76,9 +94,14 @@ def status(type, message=None):
         # For development mode
         return
 
+    # requests is slow to import and only needed here.
+    import requests
+
     # send status update to the box
-    r = requests.post(url, data={'type': type, 'message': message})
-    r.raise_for_status()
+    with trace.span('status', url):
+        r = requests.post(url, data={'type': type, 'message': message})
+        r.raise_for_status()
+        trace.phase('wait', r.elapsed.total_seconds(), len(r.content))
     return r.content
 
 def swimport(scrapername):
@@ -1,21 +1,32 @@
 #!/usr/bin/env python
 from __future__ import absolute_import
 
+import csv
 import datetime
+import gzip
+import io
 import json
 import os
 import re
 import shutil
+import socket
 import sqlite3
+import tempfile
+import threading
+import time
 import warnings
 
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE
 from textwrap import dedent
 
 from unittest import TestCase, main
 
 import scraperwiki
+import scraperwiki.scheduler as scheduler_module
+import scraperwiki.trace
 import six
+from scraperwiki.scheduler import Scheduler
 
 import sys
 # scraperwiki.sql._State.echo = True
@@ -279,6 +290,771 @@ class TestSave(SaveAndCheck):
         scraperwiki.sql.execute(u"DROP TABLE dropper\xaa")
         scraperwiki.sql.save([], dict(foo=9), table_name=u"dropper\xaa")
 
+class TestBackends(TestCase):
+    def raw_rows(self, table):
+        connection = sqlite3.connect(DB_NAME)
+        cursor = connection.cursor()
+        cursor.execute(u"SELECT * FROM [%s]" % table)
+        rows = cursor.fetchall()
+        connection.close()
+        return rows
+
+    def test_sqlite3_matches_sqlalchemy(self):
+        rows = [
+            {u'id': 1, u'text\xaa': u'\u1234', u'float': 1.5, u'bool': True,
+             u'date': datetime.date(2015, 1, 2),
+             u'datetime': datetime.datetime(2015, 1, 2, 3, 4, 5),
+             u'blob': scraperwiki.sql.Blob(b'\x00\xff')},
+            # A new column on a later row.
+            {u'id': 2, u'extra': u'grown'},
+        ]
+        try:
+            for backend in ['sqlalchemy', 'sqlite3']:
+                scraperwiki.sql._State.backend = backend
+                scraperwiki.sql.save([u'id'], rows, table_name=backend)
+        finally:
+            scraperwiki.sql._State.backend = scraperwiki.sql.DATABASE_BACKEND
+        scraperwiki.sql.commit_transactions()
+
+        self.assertEqual(self.raw_rows('sqlalchemy'), self.raw_rows('sqlite3'))
+        self.assertEqual(scraperwiki.sql.show_tables()['sqlalchemy'],
+                         scraperwiki.sql.show_tables()['sqlite3']
+                         .replace('sqlite3', 'sqlalchemy'))
+
+class TestMaintain(TestCase):
+    def test_maintain(self):
+        directory = tempfile.mkdtemp()
+        try:
+            env = dict(os.environ, SCRAPERWIKI_DATABASE_NAME='sqlite:///' +
+                       os.path.join(directory, 'maintained.sqlite'))
+            script = dedent(u"""
+              import json
+              import scraperwiki
+              scraperwiki.sql.save(['id'], [dict(id=i, text=u'x' * 1000)
+                                            for i in range(500)])
+              scraperwiki.sql.execute('DELETE FROM swdata')
+              print(json.dumps(scraperwiki.sql.maintain()))
+              print(scraperwiki.sql.execute('PRAGMA auto_vacuum')['data'][0][0])
+              """)
+            process = Popen([sys.executable, "-c", script],
+                            stdout=PIPE, stderr=PIPE, env=env)
+            stdout, stderr = process.communicate()
+            self.assertEqual(stderr, b"")
+            report, auto_vacuum = stdout.decode('utf-8').splitlines()
+            report = json.loads(report)
+            self.assertTrue(report['analyzed'])
+            self.assertGreater(report['freed_pages'], 100)
+            self.assertEqual(auto_vacuum, u'2')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_zero_budget_does_nothing(self):
+        report = scraperwiki.sql.maintain(budget=0)
+        self.assertEqual(report, dict(analyzed=False, freed_pages=0,
+                                      checkpointed=False))
+
+    def test_automatic_run_skips_when_locked(self):
+        scraperwiki.sql.save(['id'], dict(id=1), table_name=u'maintained')
+        scraperwiki.sql.commit_transactions()
+        other = sqlite3.connect(DB_NAME, isolation_level=None)
+        other.execute('BEGIN IMMEDIATE')
+        try:
+            start = time.time()
+            report = scraperwiki.sql._maintain(None, wait=False)
+            self.assertLess(time.time() - start, 5)
+            self.assertFalse(report['analyzed'])
+        finally:
+            other.execute('ROLLBACK')
+            other.close()
+            scraperwiki.sql.execute(u'DROP TABLE maintained')
+
+class TestCoordinatedWrites(TestCase):
+    def setUp(self):
+        scraperwiki.sql._State.coordinated = True
+
+    def tearDown(self):
+        scraperwiki.sql._State.coordinated = scraperwiki.sql.COORDINATED_WRITES
+        for table in (u'coord_a', u'coord_b', u'coord_t'):
+            scraperwiki.sql.execute(u'DROP TABLE IF EXISTS {}'.format(table))
+        if os.path.exists(DB_NAME + '-lock'):
+            os.remove(DB_NAME + '-lock')
+
+    def count(self, table):
+        return scraperwiki.sql.select(u'count(*) AS n FROM ' + table)[0]['n']
+
+    def test_bad_row_fails_its_save(self):
+        scraperwiki.sql.save(['id'], [dict(id=1, v=u'a'), dict(id=2, v=u'b')],
+                             table_name=u'coord_a')
+        with self.assertRaises(TypeError):
+            scraperwiki.sql.save(['id'], [dict(id=3, v=u'c'), dict(id=4, v=object())],
+                                 table_name=u'coord_a')
+        scraperwiki.sql.save(['id'], dict(id=3, v=u'ok'), table_name=u'coord_b')
+        self.assertEqual(self.count(u'coord_a'), 2)
+        self.assertEqual(self.count(u'coord_b'), 1)
+
+    def test_failed_batch_is_rolled_back(self):
+        scraperwiki.sql._State.coordinated = False
+        scraperwiki.sql.save(['id'], dict(id=0, v=u'text'), table_name=u'coord_t')
+        scraperwiki.sql._State.coordinated = True
+        scraperwiki.sql.save(['id'], dict(id=1, v=u'a'), table_name=u'coord_a')
+        # A dict can't go in the existing TEXT column.
+        scraperwiki.sql.save(['id'], [dict(id=1, v=u'fine'), dict(id=2, v={u'x': 1})],
+                             table_name=u'coord_t')
+        scraperwiki.sql.save(['id'], dict(id=3, v=u'ok'), table_name=u'coord_b')
+        with self.assertRaises(Exception):
+            scraperwiki.sql.flush()
+        self.assertEqual(self.count(u'coord_a'), 1)
+        self.assertEqual(self.count(u'coord_t'), 1)
+        self.assertEqual(self.count(u'coord_b'), 1)
+
+    def test_concurrent_writers(self):
+        directory = tempfile.mkdtemp()
+        try:
+            env = dict(os.environ,
+                       SCRAPERWIKI_COORDINATED_WRITES='1',
+                       SCRAPERWIKI_WRITE_BATCH_SIZE='50',
+                       SCRAPERWIKI_DATABASE_NAME='sqlite:///' +
+                       os.path.join(directory, 'shared.sqlite'))
+            script = dedent(u"""
+              import sys
+              import scraperwiki
+              writer = int(sys.argv[1])
+              for i in range(300):
+                  row = dict(id=writer * 1000 + i, writer=writer)
+                  if i == 150:
+                      row[u'column%d' % writer] = i
+                  scraperwiki.sql.save(['id'], row)
+              scraperwiki.sql.save_var(u'writer%d' % writer, u'done')
+              """)
+            processes = [Popen([sys.executable, "-c", script, str(writer)],
+                               stdout=PIPE, stderr=PIPE, env=env)
+                         for writer in range(4)]
+            for process in processes:
+                stdout, stderr = process.communicate()
+                self.assertEqual(stderr, b"")
+                self.assertEqual(process.returncode, 0)
+
+            connection = sqlite3.connect(os.path.join(directory, 'shared.sqlite'))
+            (count,), = connection.execute('SELECT count(*) FROM swdata')
+            (done,), = connection.execute('SELECT count(*) FROM swvariables')
+            connection.close()
+            self.assertEqual(count, 1200)
+            self.assertEqual(done, 4)
+        finally:
+            shutil.rmtree(directory)
+
+class TestShard(TestCase):
+    def setUp(self):
+        from scraperwiki import shard
+        self.shard = shard
+        self.directory = tempfile.mkdtemp()
+        shard.configure(3, os.path.join(self.directory, u'shard{}.sqlite'))
+
+    def tearDown(self):
+        self.shard.configure(self.shard.DATABASE_SHARDS)
+        shutil.rmtree(self.directory)
+
+    def count(self, number):
+        connection = sqlite3.connect(self.shard._State.path.format(number))
+        (count,), = connection.execute('SELECT count(*) FROM swdata')
+        connection.close()
+        return count
+
+    def test_rows_spread_over_shards(self):
+        self.shard.save(['id'], [dict(id=i, value=i * 2) for i in range(90)])
+        self.shard.save(['id'], [dict(id=i, value=0) for i in range(10)])
+        self.shard.commit()
+
+        counts = [self.count(number) for number in range(3)]
+        self.assertEqual(sum(counts), 90)
+        self.assertTrue(all(counts))
+        self.assertEqual(
+            self.shard.select('count(*) AS n, sum(value) AS total FROM swdata'),
+            [dict(n=90, total=sum(i * 2 for i in range(10, 90)))])
+
+    def test_partition(self):
+        self.shard.save(['id'], [dict(id=i, source=u'a\xaa') for i in range(20)],
+                        partition='source')
+        self.shard.commit()
+        self.assertEqual(
+            [self.has_swdata(number) for number in range(3)].count(True), 1)
+        self.assertEqual(len(self.shard.select('* FROM swdata')), 20)
+
+    def has_swdata(self, number):
+        connection = sqlite3.connect(self.shard._State.path.format(number))
+        tables = connection.execute(
+            "SELECT name FROM sqlite_master WHERE name='swdata'").fetchall()
+        connection.close()
+        return bool(tables)
+
+    def test_schema_growth(self):
+        self.shard.save(['id'], [dict(id=i) for i in range(10)])
+        self.shard.save(['id'], dict(id=10, extra=u'\u1234'))
+        rows = self.shard.select('* FROM swdata ORDER BY id')
+        self.assertEqual(len(rows), 11)
+        self.assertEqual(rows[0], dict(id=0, extra=None))
+        self.assertEqual(rows[10], dict(id=10, extra=u'\u1234'))
+
+    def test_decodes_json_and_compressed_columns(self):
+        html = u'<p>caf\xe9</p>' * 1000
+        self.shard.save(['id'], [dict(id=i, doc={u'a': [i]},
+                                      html=scraperwiki.sql.CompressedText(html))
+                                 for i in range(5)])
+        rows = [dict(id=i, doc={u'a': [i]}, html=html) for i in range(5)]
+        self.assertEqual(self.shard.select('* FROM swdata ORDER BY id'), rows)
+        self.shard.configure(self.shard.MAX_ATTACHED + 1,
+                             os.path.join(self.directory, u'many{}.sqlite'))
+        self.shard.save(['id'], [dict(id=i, doc={u'a': [i]},
+                                      html=scraperwiki.sql.CompressedText(html))
+                                 for i in range(5)])
+        self.assertEqual(self.shard.select('* FROM swdata ORDER BY id'), rows)
+
+    def test_merge_beyond_attach_limit(self):
+        self.shard.configure(self.shard.MAX_ATTACHED + 1,
+                             os.path.join(self.directory, u'many{}.sqlite'))
+        self.shard.save(['id'], [dict(id=i) for i in range(50)])
+        self.shard.save(['id'], dict(id=50, extra=u'\u1234'))
+        rows = self.shard.select('id FROM swdata')
+        self.assertEqual(sorted(row['id'] for row in rows), list(range(51)))
+        self.assertEqual(self.shard.select('count(*) AS n FROM swdata'),
+                         [dict(n=51)])
+        self.assertEqual(
+            self.shard.select('id, extra FROM swdata ORDER BY id DESC LIMIT 2'),
+            [dict(id=50, extra=u'\u1234'), dict(id=49, extra=None)])
+
+class TestExport(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rows = [dict(id=i, name=u'\u1234%d' % i, data=b'\x00\xff')
+                     for i in range(25)]
+        scraperwiki.sql.save(['id'], self.rows, table_name=u'export\xaa')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_csv(self):
+        path = os.path.join(self.directory, 'out.csv')
+        count = scraperwiki.sql.export(u'export\xaa', path, chunk_size=10)
+        self.assertEqual(count, 25)
+        with io.open(path, encoding='utf-8', newline='') as f:
+            lines = list(csv.reader(f))
+        self.assertEqual(lines[0], ['id', 'name', 'data'])
+        self.assertEqual(lines[1], ['0', u'\u12340', 'AP8='])
+        self.assertEqual(len(lines), 26)
+
+    def test_jsonl_gzip(self):
+        path = os.path.join(self.directory, 'out.jsonl.gz')
+        scraperwiki.sql.export(u'export\xaa', path, format='jsonl',
+                               compression='gzip', chunk_size=7)
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(rows[-1], dict(id=24, name=u'\u123424', data='AP8='))
+        self.assertEqual(len(rows), 25)
+
+    def test_parquet(self):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            self.skipTest("needs pyarrow")
+        path = os.path.join(self.directory, 'out.parquet')
+        scraperwiki.sql.export(u'export\xaa', path, format='parquet',
+                               chunk_size=10)
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual(table.to_pylist(), self.rows)
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, scraperwiki.sql.export, u'export\xaa',
+                          os.path.join(self.directory, 'out'), format='xml')
+
+class TestChanges(TestCase):
+    def changes(self, table, token=0):
+        return list(scraperwiki.sql.changes_since(table, token))
+
+    def test_save_tracks_new_table(self):
+        scraperwiki.sql._State.track_changes = True
+        try:
+            scraperwiki.sql.save(['id'], [dict(id=i, v=u'a') for i in range(5)],
+                                 table_name=u'tracked\xaa')
+        finally:
+            scraperwiki.sql._State.track_changes = scraperwiki.sql.TRACK_CHANGES
+
+        changes = self.changes(u'tracked\xaa')
+        self.assertEqual([row for _, row in changes],
+                         [dict(id=i, v=u'a') for i in range(5)])
+        token = changes[-1][0]
+
+        scraperwiki.sql.save(['id'], [dict(id=2, v=u'b'), dict(id=7, v=u'b')],
+                             table_name=u'tracked\xaa')
+        scraperwiki.sql.execute(u'UPDATE [tracked\xaa] SET v = ? WHERE id = 0',
+                                [u'c'])
+        changes = self.changes(u'tracked\xaa', token)
+        self.assertEqual([row for _, row in changes],
+                         [dict(id=2, v=u'b'), dict(id=7, v=u'b'),
+                          dict(id=0, v=u'c')])
+        self.assertEqual(self.changes(u'tracked\xaa', changes[-1][0]), [])
+
+    def test_resave_keeps_one_entry_per_row(self):
+        scraperwiki.sql.save(['id'], [dict(id=i) for i in range(5)],
+                             table_name=u'resaved')
+        scraperwiki.sql.track_changes(u'resaved')
+        for _ in range(3):
+            scraperwiki.sql.save(['id'], [dict(id=i) for i in range(5)],
+                                 table_name=u'resaved')
+        entries = scraperwiki.sql.select(
+            u"count(*) AS n FROM swchanges WHERE table_name = 'resaved'")
+        self.assertEqual(entries, [dict(n=5)])
+        self.assertEqual(len(self.changes(u'resaved')), 5)
+
+    def test_resave_leaves_user_triggers_alone(self):
+        scraperwiki.sql.save(['id'], dict(id=1), table_name=u'audited')
+        scraperwiki.sql.execute(u'CREATE TABLE audit (id)')
+        scraperwiki.sql.execute(u'CREATE TRIGGER audited_delete AFTER DELETE '
+                                u'ON audited BEGIN INSERT INTO audit '
+                                u'VALUES (OLD.id); END')
+        try:
+            scraperwiki.sql.save(['id'], dict(id=1), table_name=u'audited')
+            self.assertEqual(scraperwiki.sql.select(u'* FROM audit'), [])
+        finally:
+            scraperwiki.sql.execute(u'DROP TABLE audited')
+            scraperwiki.sql.execute(u'DROP TABLE audit')
+
+    def test_decodes_json_and_compressed_columns(self):
+        html = u'<p>caf\xe9</p>' * 1000
+        scraperwiki.sql.save(['id'], dict(id=1, doc={u'a': [1]},
+                                          html=scraperwiki.sql.CompressedText(html)),
+                             table_name=u'tracked_docs')
+        scraperwiki.sql.track_changes(u'tracked_docs')
+        self.assertEqual([row for _, row in self.changes(u'tracked_docs')],
+                         [dict(id=1, doc={u'a': [1]}, html=html)])
+
+    def test_track_existing_table(self):
+        scraperwiki.sql.save(['id'], [dict(id=i) for i in range(3)],
+                             table_name=u'untracked')
+        scraperwiki.sql.track_changes(u'untracked')
+        self.assertEqual(len(self.changes(u'untracked')), 3)
+        scraperwiki.sql.track_changes(u'untracked')
+        self.assertEqual(len(self.changes(u'untracked')), 3)
+
+class TestIndexAdvisor(TestCase):
+    def setUp(self):
+        scraperwiki.sql.save([], [dict(a=i, b=i % 7, c=u'x') for i in range(50)],
+                             table_name=u'advised')
+        scraperwiki.sql._State.index_suggestions = {}
+
+    def tearDown(self):
+        scraperwiki.sql._State.index_advisor = scraperwiki.sql.INDEX_ADVISOR
+        scraperwiki.sql.execute(u'DROP TABLE advised')
+
+    def plan(self, query):
+        return scraperwiki.sql.execute(u'EXPLAIN QUERY PLAN ' + query)['data']
+
+    def test_log(self):
+        scraperwiki.sql._State.index_advisor = 'log'
+        for _ in range(3):
+            scraperwiki.sql.select(u'* FROM advised WHERE c = ? AND b > 3', [u'x'])
+        scraperwiki.sql.select(u'* FROM advised AS s WHERE s.a IN (1, 2)')
+        scraperwiki.sql.select(u'count(*) FROM advised')
+        self.assertEqual(scraperwiki.sql.index_suggestions(), [
+            dict(table=u'advised', columns=[u'c', u'b'], hits=3),
+            dict(table=u'advised', columns=[u'a'], hits=1)])
+
+    def test_create(self):
+        scraperwiki.sql._State.index_advisor = 'create'
+        query = u'* FROM advised WHERE b = 3'
+        self.assertTrue(self.plan(u'SELECT ' + query)[0][-1].startswith('SCAN'))
+        scraperwiki.sql.select(query)
+        self.assertIn(u'USING INDEX advised_b',
+                      self.plan(u'SELECT ' + query)[0][-1])
+        self.assertEqual(scraperwiki.sql.index_suggestions(), [])
+
+    def test_update_filters_on_where_clause_only(self):
+        scraperwiki.sql._State.index_advisor = 'create'
+        scraperwiki.sql.execute(u'UPDATE advised SET c = ? WHERE a = 5', [u'y'])
+        self.assertEqual(scraperwiki.sql.index_suggestions(), [
+            dict(table=u'advised', columns=[u'a'], hits=1)])
+
+    def test_create_index_on_named_table(self):
+        scraperwiki.sql.save([], dict(other=1))
+        scraperwiki.sql.create_index([u'c'], table_name=u'advised')
+        self.assertIn(u'USING INDEX advised_c',
+                      self.plan(u"SELECT * FROM advised WHERE c = 'x'")[0][-1])
+
+class TestJSON(TestCase):
+    def setUp(self):
+        self.rows = [dict(id=i, doc={u'a\xaa': {u'b': i}, u'list': [i, u'x']},
+                          tags=[u't%d' % i]) for i in range(20)]
+        scraperwiki.sql.save(['id'], self.rows, table_name=u'documents')
+
+    def tearDown(self):
+        scraperwiki.sql.execute(u'DROP TABLE documents')
+
+    def test_select(self):
+        scraperwiki.sql.save(['id'], dict(id=99, doc=None), table_name=u'documents')
+        self.assertEqual(scraperwiki.sql.select(u'* FROM documents WHERE id < 2'),
+                         self.rows[:2])
+        self.assertEqual(scraperwiki.sql.select(u'doc FROM documents WHERE id = 99'),
+                         [dict(doc=None)])
+
+    def test_select_decodes_by_column_origin(self):
+        scraperwiki.sql.save(['id'], dict(id=1, doc=u'123'), table_name=u'plain')
+        try:
+            self.assertEqual(scraperwiki.sql.select(
+                u'p.doc, d.doc AS other FROM plain AS p '
+                u'JOIN documents AS d ON d.id = p.id'),
+                [dict(doc=u'123', other=self.rows[1]['doc'])])
+            self.assertEqual(scraperwiki.sql.select(
+                u"'5' AS doc, tags FROM documents WHERE id = ?", [0]),
+                [dict(doc=u'5', tags=[u't0'])])
+            self.assertEqual(scraperwiki.sql.select(
+                u"doc FROM (SELECT doc FROM documents WHERE id = 0) "
+                u"WHERE doc != '?'"), [dict(doc=self.rows[0]['doc'])])
+        finally:
+            scraperwiki.sql.execute(u'DROP TABLE plain')
+
+    def test_select_checks_only_queries_that_may_decode(self):
+        scraperwiki.sql.save(['id'], dict(id=1, v=u'{}'), table_name=u'plain')
+        scraperwiki.sql.execute(u'CREATE TEMP VIEW swresult AS SELECT 1')
+        scraperwiki.sql.execute(u'CREATE VIEW docs AS SELECT doc FROM documents')
+        try:
+            query = u'* FROM plain WHERE id = ?'
+            self.assertEqual(scraperwiki.sql.select(query, [1]),
+                             [dict(id=1, v=u'{}')])
+            self.assertEqual(scraperwiki.sql._State.result_types[u'select ' + query],
+                             [])
+            self.assertEqual(scraperwiki.sql.select(u'doc FROM docs LIMIT 1'),
+                             [dict(doc=self.rows[0]['doc'])])
+        finally:
+            scraperwiki.sql.execute(u'DROP VIEW docs')
+            scraperwiki.sql.execute(u'DROP VIEW temp.swresult')
+            scraperwiki.sql.execute(u'DROP TABLE plain')
+
+    def test_stored_as_json(self):
+        self.assertIn(u'doc JSON', scraperwiki.sql.show_tables()[u'documents'])
+        connection = sqlite3.connect(DB_NAME)
+        value, = connection.execute(
+            u"SELECT json_extract(doc, '$.list[1]') FROM documents").fetchone()
+        connection.close()
+        self.assertEqual(value, u'x')
+
+    def test_json_path_index(self):
+        scraperwiki.sql.create_index([u'doc$.a\xaa.b'], table_name=u'documents')
+        plan = scraperwiki.sql.execute(
+            u'EXPLAIN QUERY PLAN SELECT id FROM documents WHERE [doc$.a\xaa.b] = 3')
+        self.assertIn(u'USING INDEX', plan['data'][0][-1])
+        self.assertEqual(
+            scraperwiki.sql.select(u'id FROM documents WHERE [doc$.a\xaa.b] = 3'),
+            [dict(id=3)])
+        scraperwiki.sql.save(['id'], dict(id=50, doc={u'a\xaa': {u'b': 3}}),
+                             table_name=u'documents')
+        self.assertEqual(
+            len(scraperwiki.sql.select(u'id FROM documents WHERE [doc$.a\xaa.b] = 3')),
+            2)
+
+    def test_var(self):
+        scraperwiki.sql.save_var(u'state', {u'seen': [1, 2]})
+        self.assertEqual(scraperwiki.sql.get_var(u'state'), {u'seen': [1, 2]})
+
+    def test_export_jsonl(self):
+        out = six.StringIO()
+        scraperwiki.sql.export(u'documents', out, format='jsonl')
+        first = json.loads(out.getvalue().splitlines()[0])
+        self.assertEqual(first, self.rows[0])
+
+class TestCompressed(TestCase):
+    def setUp(self):
+        self.html = u'<p>caf\xe9</p>' * 1000
+        self.pdf = b'%PDF-1.4 ' * 1000
+        scraperwiki.sql.save(['id'], [
+            dict(id=1, html=scraperwiki.sql.CompressedText(self.html),
+                 pdf=scraperwiki.sql.CompressedBlob(self.pdf)),
+            dict(id=2, html=scraperwiki.sql.CompressedText(u'short'),
+                 pdf=scraperwiki.sql.CompressedBlob(b'\x00swz')),
+        ], table_name=u'pages')
+
+    def tearDown(self):
+        scraperwiki.sql.execute(u'DROP TABLE pages')
+
+    def test_select(self):
+        scraperwiki.sql.save(['id'], dict(id=3, html=self.html, pdf=None),
+                             table_name=u'pages')
+        self.assertEqual(scraperwiki.sql.select(u'* FROM pages ORDER BY id'), [
+            dict(id=1, html=self.html, pdf=self.pdf),
+            dict(id=2, html=u'short', pdf=b'\x00swz'),
+            dict(id=3, html=self.html, pdf=None)])
+
+    def test_stored_compressed(self):
+        self.assertIn(u'html ZTEXT', scraperwiki.sql.show_tables()[u'pages'])
+        connection = sqlite3.connect(DB_NAME)
+        sizes = connection.execute(
+            u'SELECT length(html), length(pdf) FROM pages ORDER BY id').fetchall()
+        connection.close()
+        self.assertLess(sizes[0][0], len(self.html) // 10)
+        self.assertLess(sizes[0][1], len(self.pdf) // 10)
+        # Below the threshold values are stored as they are.
+        self.assertEqual(sizes[1][0], len(u'short'))
+
+    def test_var(self):
+        scraperwiki.sql.save_var(u'page', scraperwiki.sql.CompressedText(self.html))
+        self.assertEqual(scraperwiki.sql.get_var(u'page'), self.html)
+        scraperwiki.sql.save_var(u'pdf', scraperwiki.sql.CompressedBlob(self.pdf))
+        self.assertEqual(scraperwiki.sql.get_var(u'pdf'), self.pdf)
+
+class TestQueue(TestCase):
+    def setUp(self):
+        from scraperwiki import queue
+        self.queue = queue
+
+    def tearDown(self):
+        scraperwiki.sql.execute(u'DELETE FROM swqueue')
+
+    def test_enqueue_claim_complete(self):
+        self.assertEqual(self.queue.enqueue([u'a', u'b', u'c']), 3)
+        self.assertEqual(self.queue.enqueue([u'b', u'd'], priority=5), 1)
+        self.assertEqual(self.queue.claim(2), [u'd', u'a'])
+        self.assertEqual(self.queue.claim(5), [u'b', u'c'])
+        self.assertEqual(self.queue.claim(), [])
+        self.queue.complete([u'a', u'b', u'c', u'd'])
+        self.assertEqual(self.queue.counts(),
+                         dict(pending=0, claimed=0, done=4, failed=0))
+        self.assertEqual(self.queue.enqueue(u'a'), 0)
+
+    def test_queues_are_separate(self):
+        self.queue.enqueue(u'a', queue=u'one')
+        self.queue.enqueue(u'a', queue=u'two')
+        self.assertEqual(self.queue.claim(queue=u'one'), [u'a'])
+        self.assertEqual(self.queue.claim(queue=u'two'), [u'a'])
+
+    def test_fail_and_retry(self):
+        self.queue.enqueue(u'a')
+        for _ in range(self.queue.MAX_ATTEMPTS):
+            self.assertEqual(self.queue.claim(), [u'a'])
+            self.queue.fail(u'a', error=u'timeout')
+        self.assertEqual(self.queue.claim(), [])
+        self.assertEqual(self.queue.counts()['failed'], 1)
+
+    def test_expired_claim_is_reclaimed(self):
+        self.queue.enqueue([u'a', u'b'])
+        self.assertEqual(self.queue.claim(2), [u'a', u'b'])
+        self.assertEqual(self.queue.claim(2, lease=60), [])
+        self.assertEqual(self.queue.claim(2, lease=0), [u'a', u'b'])
+
+    def test_finish_only_claimed_items(self):
+        self.queue.enqueue([u'a', u'b'])
+        self.queue.complete(u'a')
+        self.assertEqual(self.queue.claim(2), [u'a', u'b'])
+        self.queue.complete(u'a')
+        self.queue.fail(u'a')
+        self.assertEqual(self.queue.counts(),
+                         dict(pending=0, claimed=1, done=1, failed=0))
+
+    def test_expired_claim_cannot_finish(self):
+        self.queue.enqueue(u'a')
+        old, _ = self.queue._claim(1, u'default', 300)
+        new, items = self.queue._claim(1, u'default', 0)
+        self.assertEqual(items, [u'a'])
+        self.queue._finish([u'a'], u'default', self.queue.DONE, None, old)
+        self.assertEqual(self.queue.counts()['claimed'], 1)
+        self.queue._finish([u'a'], u'default', self.queue.DONE, None, new)
+        self.assertEqual(self.queue.counts()['done'], 1)
+
+    def test_claim_in_another_process(self):
+        self.queue.enqueue([u'a', u'b'])
+        self.assertEqual(self.queue.claim(), [u'a'])
+        claimed = Popen([sys.executable, '-c', 'from scraperwiki import queue; '
+                         'print(queue.claim(5))'], stdout=PIPE).communicate()[0]
+        self.assertEqual(claimed.strip(), b"['b']")
+
+    def test_crawl(self):
+        links = {u'/': [u'/a', u'/b'], u'/a': [u'/b', u'/c'], u'/b': [],
+                 u'/c': [u'/'], u'/broken': []}
+        handled = []
+
+        def fetch(url):
+            if url == u'/broken':
+                raise IOError(url)
+            return links[url]
+
+        def handle(url, content):
+            handled.append(url)
+            scraperwiki.sql.save(['url'], dict(url=url), table_name=u'crawled')
+            self.queue.enqueue(content)
+
+        self.queue.enqueue([u'/', u'/broken'])
+        self.queue.crawl(handle, workers=2, batch=1, fetch=fetch)
+        self.assertEqual(sorted(handled), [u'/', u'/a', u'/b', u'/c'])
+        self.assertEqual(len(scraperwiki.sql.select(u'* FROM crawled')), 4)
+        self.assertEqual(self.queue.counts(),
+                         dict(pending=0, claimed=0, done=4, failed=1))
+
+class StubHandler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler):
+    # Paths starting /throttled answer 429 on their first request.
+    throttled = set()
+
+    def do_GET(self):
+        if self.path.startswith('/throttled') and self.path not in self.throttled:
+            self.throttled.add(self.path)
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.end_headers()
+            return
+        if self.path.startswith('/error'):
+            self.send_error(500)
+            return
+        body = self.path.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StubServerTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        server = type('StubServer', (six.moves.socketserver.ThreadingMixIn,
+                                     six.moves.BaseHTTPServer.HTTPServer),
+                      dict(daemon_threads=True))
+        cls.server = server(('127.0.0.1', 0), StubHandler)
+        cls.url = 'http://127.0.0.1:{}'.format(cls.server.server_address[1])
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+class TestScheduler(StubServerTestCase):
+
+    def test_scrape(self):
+        self.assertEqual(scraperwiki.scrape(self.url + '/plain'), b'/plain')
+
+    def test_rate_limit(self):
+        scheduler = Scheduler(rate=20)
+        start = time.time()
+        for i in range(6):
+            self.assertEqual(scraperwiki.scrape(self.url + '/%d' % i,
+                                                scheduler=scheduler),
+                             b'/%d' % i)
+        self.assertGreaterEqual(time.time() - start, 0.25)
+
+    def test_retry_after(self):
+        scheduler = Scheduler()
+        start = time.time()
+        self.assertEqual(scraperwiki.scrape(self.url + '/throttled',
+                                            scheduler=scheduler),
+                         b'/throttled')
+        self.assertGreaterEqual(time.time() - start, 1)
+        stats = scheduler.stats()['127.0.0.1:%d' % self.server.server_address[1]]
+        self.assertEqual((stats['requests'], stats['throttled']), (2, 1))
+
+    def test_adaptive_concurrency(self):
+        scheduler = Scheduler(max_concurrency=4)
+        host = '127.0.0.1:%d' % self.server.server_address[1]
+        pool = ThreadPool(8)
+        try:
+            pool.map(lambda i: scraperwiki.scrape(self.url + '/%d' % i,
+                                                  scheduler=scheduler),
+                     range(40))
+        finally:
+            pool.close()
+        self.assertEqual(scheduler.stats()[host]['concurrency'], 4)
+        with self.assertRaises(six.moves.urllib.error.HTTPError):
+            scraperwiki.scrape(self.url + '/error', scheduler=scheduler)
+        self.assertEqual(scheduler.stats()[host]['concurrency'], 2)
+
+    def test_crawl(self):
+        from scraperwiki import queue
+        urls = [self.url + '/crawl/%d' % i for i in range(10)]
+        queue.enqueue(urls + [self.url + '/throttled/crawl'], queue=u'stub')
+        handled = {}
+        queue.crawl(lambda url, content: handled.update({url: content}),
+                    queue=u'stub', workers=4)
+        self.assertEqual(len(handled), 11)
+        self.assertEqual(handled[urls[3]], b'/crawl/3')
+
+    def test_retry_after_date(self):
+        self.assertEqual(scheduler_module._retry_after(None, 2), 4)
+        self.assertEqual(scheduler_module._retry_after('Thu, 01 Jan 1970 '
+                                                       '00:00:00 GMT', 0), 0)
+
+class TestTrace(StubServerTestCase):
+    def setUp(self):
+        self.events = []
+        self.aggregator = scraperwiki.trace.Aggregator()
+        scraperwiki.trace.add_hook(self.events.append)
+        scraperwiki.trace.add_hook(self.aggregator)
+
+    def tearDown(self):
+        scraperwiki.trace.remove_hook(self.events.append)
+        scraperwiki.trace.remove_hook(self.aggregator)
+
+    def test_scrape(self):
+        for i in range(3):
+            scraperwiki.scrape(self.url + '/traced%d' % i)
+        scraperwiki.scrape(self.url + '/traced', scheduler=Scheduler())
+        host = '127.0.0.1:%d' % self.server.server_address[1]
+        event = self.events[0]
+        self.assertEqual((event['operation'], event['host'], event['bytes']),
+                         ('scrape', host, len(b'/traced0')))
+        self.assertEqual(sorted(event['phases']),
+                         ['connect', 'dns', 'download', 'wait'])
+        self.assertLessEqual(sum(event['phases'].values()), event['duration'])
+
+        summary = self.aggregator.summary()[('scrape', host)]
+        self.assertEqual((summary['count'], summary['errors'], summary['bytes']),
+                         (4, 0, 3 * len(b'/traced0') + len(b'/traced')))
+        self.assertEqual(set(summary['phases']),
+                         set(['total', 'connect', 'dns', 'download', 'wait']))
+        total = summary['phases']['total']
+        self.assertTrue(0 < total['p50'] <= total['p90'] <= total['p99'])
+
+    def test_connection_disables_nagle(self):
+        connection = six.moves.http_client.HTTPConnection(
+            *self.server.server_address[:2])
+        from scraperwiki import _tracehttp
+        sock = _tracehttp._connect(connection)
+        try:
+            self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP,
+                                            socket.TCP_NODELAY))
+        finally:
+            sock.close()
+
+    def test_error(self):
+        with self.assertRaises(six.moves.urllib.error.HTTPError):
+            scraperwiki.scrape(self.url + '/error')
+        self.assertIn('HTTPError', self.events[0]['error'])
+
+    def test_report(self):
+        self.aggregator(dict(operation='pdftoxml', host=None, bytes=100,
+                             error=None, duration=2.0, pages=4,
+                             phases=dict(convert=1.5)))
+        out = six.StringIO()
+        self.aggregator.report(out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'pdftoxml -: 1 calls, 0 errors, 100 bytes, '
+                                   '0.375s per page')
+        self.assertEqual(lines[1].split()[:3], ['total', 'p50', '2000.0ms'])
+        self.assertEqual(lines[2].split()[0], 'convert')
+
+    def test_report_at_exit(self):
+        script = 'import scraperwiki; scraperwiki.scrape(%r)' % (self.url + '/exit')
+        process = Popen([sys.executable, '-c', script], stderr=PIPE,
+                        env=dict(os.environ, SCRAPERWIKI_TRACE='1'))
+        stderr = process.communicate()[1].decode('utf-8')
+        self.assertIn(u'scrape 127.0.0.1:', stderr)
+        self.assertIn(u'  download ', stderr)
+
+    def test_no_hooks(self):
+        scraperwiki.trace.remove_hook(self.events.append)
+        scraperwiki.trace.remove_hook(self.aggregator)
+        with scraperwiki.trace.span('scrape', self.url) as event:
+            self.assertIsNone(event)
+        scraperwiki.trace.add_hook(self.events.append)
+        scraperwiki.trace.add_hook(self.aggregator)
+
 class TestQuestionMark(TestCase):
     def test_one_question_mark_with_nonlist(self):
         scraperwiki.sql.execute(u'CREATE TABLE zhuozi\xaa (\xaa TEXT);')
@@ -388,5 +1164,23 @@ class TestImports(TestCase):
     def test_import_scraperwiki_special_utils(self):
         self.sw.pdftoxml
 
+    def test_import_is_lazy(self):
+        if sys.version_info < (3, 7):
+            self.skipTest("needs module __getattr__")
+        script = dedent(u"""
+          import sys
+          import scraperwiki
+          scraperwiki.scrape, scraperwiki.status, scraperwiki.utils
+          heavy = ['sqlalchemy', 'alembic', 'requests', 'http.client', 'ssl']
+          print(' '.join(m for m in heavy if m in sys.modules))
+          scraperwiki.sqlite.save
+          print('sqlalchemy' in sys.modules)
+          """)
+        process = Popen([sys.executable, "-c", script],
+                        stdout=PIPE, stderr=PIPE)
+        stdout, stderr = process.communicate()
+        self.assertEqual(stderr, b"")
+        self.assertEqual(stdout.decode('utf-8').split('\n'), ['', 'True', ''])
+
 if __name__ == '__main__':
     main()